@@ -0,0 +1,55 @@
+# coding: utf8
+"""
+    Per-page Markdown rendering cost
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares ``markdown.markdown()``, which builds a new converter and loads
+    its extensions for every document, with :func:`pygmented_markdown`,
+    which reuses one converter per thread::
+
+        $ python benchmarks/markdown_render.py [number of pages]
+
+    :copyright: (c) 2010 by Simon Sapin.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import sys
+import timeit
+
+import markdown
+
+from flask_flatpages import pygmented_markdown
+
+
+BODY = u'''\
+A paragraph with *emphasis*, a [link](http://example.com/) and `code`.
+
+* one
+* two
+* three
+
+    :::python
+    def hello():
+        return 'world'
+'''
+
+
+def main(number=500):
+    extensions = ('codehilite', 'headerid')
+    pygmented_markdown.markdown_extensions = extensions
+
+    def fresh():
+        markdown.markdown(BODY, extensions=list(extensions))
+
+    def reused():
+        pygmented_markdown(BODY)
+
+    for name, function in (('markdown.markdown', fresh),
+                           ('pygmented_markdown', reused)):
+        function()  # warm up imports
+        best = min(timeit.repeat(function, number=number, repeat=3))
+        print '%-20s %8.1f µs/page' % (name, best / number * 1e6)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,93 @@
+# coding: utf8
+"""
+    Memory used per page
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Loads a tree of synthetic pages and reports the resident memory growth
+    per page after loading, after parsing metadata (keeping or dropping its
+    YAML source) and after rendering::
+
+        $ python benchmarks/page_memory.py [number of pages]
+
+    Each stage runs in a fresh child process. Linux only (uses
+    ``/proc/self/statm`` and ``fork()``).
+
+    :copyright: (c) 2010 by Simon Sapin.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+
+from flask import Flask
+
+from flask_flatpages import FlatPages
+
+
+PAGE = u'''\
+title: Page number %(i)d
+date: 2013-04-%(day)02d
+tags: [one, two, tag%(tag)d]
+
+Some *text* for page %(i)d.
+'''
+
+
+def make_tree(root, count):
+    for i in xrange(count):
+        directory = os.path.join(root, 'dir%d' % (i // 1000))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'page%d.html' % i), 'w') as fd:
+            fd.write(PAGE % dict(i=i, day=i % 28 + 1, tag=i % 10))
+
+
+def rss():
+    with open('/proc/self/statm') as fd:
+        return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(root, count, stage):
+    app = Flask(__name__)
+    app.config['FLATPAGES_ROOT'] = root
+    app.config['FLATPAGES_KEEP_META_YAML'] = stage != 'meta-noyaml'
+    pages = FlatPages(app)
+    gc.collect()
+    before = rss()
+    for page in pages:
+        if stage in ('meta', 'meta-noyaml', 'html'):
+            page.meta
+        if stage == 'html':
+            page.html
+    gc.collect()
+    page = pages.get('dir0/page0')
+    size = sys.getsizeof(page)
+    if hasattr(page, '__dict__'):
+        size += sys.getsizeof(page.__dict__)
+    print '%-12s %8.0f bytes/page (Page object: %d bytes)' % (
+        stage, float(rss() - before) / count, size)
+
+
+def main(count=20000):
+    root = tempfile.mkdtemp()
+    try:
+        make_tree(root, count)
+        for stage in ('load', 'meta', 'meta-noyaml', 'html'):
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    measure(root, count, stage)
+                    sys.stdout.flush()
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
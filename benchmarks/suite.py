@@ -0,0 +1,338 @@
+# coding: utf8
+"""
+    Flask-FlatPages benchmark suite
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Generates a synthetic tree of pages and times loading, reloading,
+    metadata parsing, rendering, filtering, searching and ordering. Results
+    are written as JSON so that runs on different versions can be compared::
+
+        $ python benchmarks/suite.py run --pages 5000 -o new.json
+        $ python benchmarks/suite.py compare old.json new.json
+
+    Times are the best of ``--repeat`` runs, in seconds.
+
+    :copyright: (c) 2010 by Simon Sapin.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import datetime
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from flask import Flask
+
+import flask_flatpages
+from flask_flatpages import FlatPages, PageList, render_jinja
+
+
+WORDS = (u'lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         u'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+def generate(root, options):
+    """Write ``options.pages`` page files under ``root``, spread over
+    directories ``options.depth`` levels deep.
+    """
+    rng = random.Random(options.seed)
+    start = datetime.date(2000, 1, 1)
+    for i in xrange(options.pages):
+        parts = []
+        n = i
+        for level in xrange(options.depth):
+            parts.append('d%d' % (n % options.fanout))
+            n //= options.fanout
+        directory = os.path.join(root, *parts)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        meta = [u'title: Page %d' % i,
+                u'date: %s' % (start + datetime.timedelta(days=i % 5000)),
+                u'tags: [%s]' % u', '.join(
+                    u'tag%d' % rng.randrange(options.tags)
+                    for _ in xrange(3))]
+        for field in xrange(options.meta_fields):
+            meta.append(u'field%d: %s' % (field, rng.choice(WORDS)))
+
+        paragraphs = []
+        length = 0
+        while length < options.body_length:
+            paragraph = u' '.join(rng.choice(WORDS) for _ in xrange(40))
+            if rng.random() < 0.2:
+                paragraph = u'*%s*' % paragraph
+            paragraphs.append(paragraph)
+            length += len(paragraph)
+        if len(paragraphs) > 1:
+            paragraphs.insert(1, u'<!-- more -->')
+
+        content = u'\n'.join(meta) + u'\n\n' + u'\n\n'.join(paragraphs)
+        filename = os.path.join(directory, 'page%d.html' % i)
+        with open(filename, 'w') as fd:
+            fd.write(content.encode('utf8'))
+
+
+def best_of(repeat, function, setup=None):
+    """Return the shortest run time of ``function``, calling ``setup``
+    untimed before each run.
+    """
+    times = []
+    for _ in xrange(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def make_pages(root, **config):
+    app = Flask(__name__)
+    app.config['FLATPAGES_ROOT'] = root
+    for key, value in config.iteritems():
+        app.config['FLATPAGES_%s' % key.upper()] = value
+    return FlatPages(app)
+
+
+def plain(text):
+    return text
+
+
+def clear_caches(pages):
+    for page in pages:
+        # Not hasattr(page): Page.__getattr__ looks up metadata.
+        if hasattr(type(page), 'clear_cache'):
+            page.clear_cache()
+        else:
+            # Versions before Page.clear_cache use cached properties.
+            for name in ('meta', 'html', 'intro'):
+                page.__dict__.pop(name, None)
+
+
+def has_filter(name):
+    """Whether the tested version has the ``name`` filter operator."""
+    return hasattr(flask_flatpages.filters, 'in_' if name == 'in' else name)
+
+
+# Operators of flask_flatpages.filters with an argument matching about
+# 1/10th of the generated pages.
+FILTERS = [
+    ('exact', dict(title='Page 7')),
+    ('exists', dict(tags__exists=True)),
+    ('contains', dict(tags__contains='tag3')),
+    ('in', dict(title__in=['Page %d' % i for i in range(0, 100, 10)])),
+    ('iexact', dict(title__iexact='page 7')),
+    ('icontains', dict(title__icontains='7')),
+    ('startswith', dict(title__startswith='Page 1')),
+    ('istartswith', dict(title__istartswith='page 1')),
+    ('gt', dict(date__gt=datetime.date(2012, 1, 1))),
+    ('gte', dict(date__gte=datetime.date(2012, 1, 1))),
+    ('lt', dict(date__lt=datetime.date(2001, 1, 1))),
+    ('lte', dict(date__lte=datetime.date(2001, 1, 1))),
+]
+
+
+# Several filters matching most of the generated pages, joined with OR or
+# AND.
+MANY = dict(tags__exists=True, date__gt=datetime.date(2000, 2, 1),
+            title__startswith='Page')
+
+
+def run(root, options):
+    results = {}
+    repeat = options.repeat
+
+    def selected(name):
+        return not options.only or any(
+            name.startswith(prefix) for prefix in options.only)
+
+    def bench(name, function, setup=None):
+        if not selected(name):
+            return
+        seconds = results[name] = best_of(repeat, function, setup)
+        print '%-30s %10.3f ms' % (name, seconds * 1000)
+        sys.stdout.flush()
+
+    bench('load.cold', lambda: make_pages(root)._pages)
+
+    if selected('load.bundle') and hasattr(FlatPages, 'build_bundle'):
+        bundle = os.path.join(root, 'pages.bundle')
+        make_pages(root).build_bundle(bundle)
+        bench('load.bundle', lambda: make_pages(root, bundle=bundle)._pages)
+        os.remove(bundle)
+
+    if selected('load.warm_reload'):
+        pages = make_pages(root, auto_reload=True)
+        pages._pages
+
+        def warm_reload():
+            with pages.app.test_request_context():
+                pages.app.preprocess_request()
+            pages._pages
+        bench('load.warm_reload', warm_reload)
+
+    if selected('load.touched'):
+        # All files touched, eg. by a checkout, but not modified
+        pages = make_pages(root)
+        for page in pages:
+            page.html
+        mtime = [0]
+
+        def touch():
+            mtime[0] += 1
+            for directory, dirs, files in os.walk(root):
+                for name in files:
+                    os.utime(os.path.join(directory, name),
+                             (mtime[0], mtime[0]))
+            pages.reload()
+
+        def reload_and_render():
+            for page in pages:
+                page.html
+        bench('load.touched', reload_and_render, touch)
+
+    if selected('page.meta'):
+        all_pages = list(make_pages(root))
+        bench('page.meta', lambda: [page.meta for page in all_pages],
+              lambda: clear_caches(all_pages))
+
+    renderers = [
+        ('markdown', {}),
+        ('jinja_markdown', dict(template_renderer=render_jinja)),
+        ('plain', dict(html_renderer=plain)),
+    ]
+    for name, config in renderers:
+        if not selected('page.html.%s' % name):
+            continue
+        rendered = list(make_pages(root, **config))
+        bench('page.html.%s' % name,
+              lambda: [page.html for page in rendered],
+              lambda: clear_caches(rendered))
+
+    if selected('page.intro_html'):
+        # Listings show intros, then the full pages are viewed.
+        rendered = list(make_pages(root))
+        bench('page.intro_html',
+              lambda: [(page.intro, page.html) for page in rendered],
+              lambda: clear_caches(rendered))
+
+    if selected('page.listing'):
+        # Intros of 50 cold pages, as on an archive page
+        listing = PageList(list(make_pages(root))[:50])
+        bench('page.listing.serial',
+              lambda: [page.intro for page in listing],
+              lambda: clear_caches(listing))
+        if hasattr(listing, 'render'):
+            bench('page.listing.render', lambda: listing.render('intro'),
+                  lambda: clear_caches(listing))
+
+    pages = make_pages(root)
+    for page in pages:
+        page.meta
+    unindexed = PageList(pages)
+    for name, kwargs in FILTERS:
+        if not has_filter(name):
+            continue
+        bench('filter.scan.%s' % name, lambda: unindexed.filter(**kwargs))
+        # The first call builds the index
+        pages.filter(**kwargs)
+        bench('filter.indexed.%s' % name, lambda: pages.filter(**kwargs))
+
+    if has_filter('gt'):
+        bench('filter.scan.or_many', lambda: unindexed.filter(**MANY))
+
+        def chained():
+            result = unindexed
+            for key, value in MANY.iteritems():
+                result = result.filter(**{key: value})
+        bench('filter.scan.and_chained', chained)
+        if hasattr(unindexed, 'filter_all'):
+            bench('filter.scan.and_many',
+                  lambda: unindexed.filter_all(**MANY))
+
+    if selected('search') and hasattr(pages, 'search'):
+        # The first call builds the index
+        pages.search('tempor')
+        bench('search', lambda: pages.search('tempor incid*', limit=10))
+
+    bench('order_by.pagelist', lambda: unindexed.order_by('-date')[:10])
+    pages.order_by('-date')
+    bench('order_by.cached', lambda: pages.order_by('-date')[:10])
+    return results
+
+
+def command_run(args):
+    parser = optparse.OptionParser('%prog run [options]')
+    parser.add_option('--pages', type='int', default=1000)
+    parser.add_option('--depth', type='int', default=2,
+                      help='directory levels')
+    parser.add_option('--fanout', type='int', default=10,
+                      help='subdirectories per directory')
+    parser.add_option('--meta-fields', type='int', default=3,
+                      help='extra metadata fields per page')
+    parser.add_option('--tags', type='int', default=30,
+                      help='number of distinct tags')
+    parser.add_option('--body-length', type='int', default=2000,
+                      help='approximate body length in characters')
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--only', action='append', metavar='PREFIX',
+                      help='only run benchmarks starting with PREFIX, '
+                           'can be repeated')
+    parser.add_option('-o', '--output', help='JSON file to write')
+    options, args = parser.parse_args(args)
+
+    root = tempfile.mkdtemp()
+    try:
+        generate(root, options)
+        results = run(root, options)
+    finally:
+        shutil.rmtree(root)
+
+    if options.output:
+        report = {
+            'version': flask_flatpages.VERSION,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'parameters': options.__dict__,
+            'results': results,
+        }
+        with open(options.output, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+
+
+def command_compare(args):
+    if len(args) != 2:
+        sys.exit('Usage: suite.py compare OLD.json NEW.json')
+    old, new = [json.load(open(filename)) for filename in args]
+    if old['parameters'] != new['parameters']:
+        print 'Warning: runs have different parameters.'
+    for name in sorted(set(old['results']) | set(new['results'])):
+        before = old['results'].get(name)
+        after = new['results'].get(name)
+        if before is None or after is None:
+            print '%-30s %s' % (name, 'only in %s' % (
+                'new' if before is None else 'old'))
+            continue
+        print '%-30s %10.3f ms %10.3f ms %7.2fx' % (
+            name, before * 1000, after * 1000,
+            before / after if after else float('inf'))
+
+
+def main(argv):
+    commands = {'run': command_run, 'compare': command_compare}
+    if len(argv) < 2 or argv[1] not in commands:
+        sys.exit('Usage: suite.py {run,compare} [arguments]')
+    commands[argv[1]](argv[2:])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
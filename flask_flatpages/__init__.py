@@ -13,74 +13,209 @@
 from __future__ import with_statement
 
 import re
+import atexit
+import bisect
+import hashlib
 import itertools
 import datetime
+import functools
 import os
+import string
+import threading
+import time
+import weakref
 
 import flask
 import markdown
 import yaml
 import werkzeug
+import werkzeug.http
 
 import filters
+from cache import RenderCache, renderer_signature
+from scanner import Scanner
+from watcher import make_watcher
+from index import CombinedIndex, MetaIndex
+from search import SearchIndex
+from timings import Timings, clock
+from bundle import BODY, HTML, INTRO, Bundle, write_bundle
+from executor import Executor, SingleFlight
 
 try:
     from pygments.formatters import HtmlFormatter as PygmentsHtmlFormatter
 except ImportError:
     pass
 
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+try:
+    import multiprocessing
+    import multiprocessing.pool
+except ImportError:
+    # Python 2.5: pages are prerendered in the calling thread.
+    multiprocessing = None
+
+try:
+    import mako.exceptions
+    import mako.lookup
+    import mako.template
+except ImportError:
+    mako = None
+
 
 VERSION = '0.5'
 
+#: The libyaml loader is many times faster, if PyYAML was built with it.
+_yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+#: Per-thread cache of :class:`markdown.Markdown` instances
+_markdown_converters = threading.local()
+
 
-def pygmented_markdown(text):
+def pygmented_markdown(text, extensions=None):
     """Render Markdown text to HTML. Uses the `Codehilite`_ extension if
     `Pygments`_ is available.
 
     Other extensions can be added with the ``FLATPAGES_MARKDOWN_EXTENSIONS``
     setting.
 
+    :param extensions: Markdown extensions, instead of the
+                       ``markdown_extensions`` attribute of this function
+                       set by the :class:`FlatPages` instance without a name.
+                       Named instances pass their own.
+
     .. _CodeHilite: http://www.freewisdom.org/projects/python-markdown/CodeHilite
     .. _Pygments: http://pygments.org/
     """
-    extensions = getattr(pygmented_markdown, 'markdown_extensions', [])
+    if extensions is None:
+        extensions = getattr(pygmented_markdown, 'markdown_extensions', ())
+    extensions = tuple(extensions)
+
+    if 'PygmentsHtmlFormatter' in globals() and \
+            'codehilite' not in extensions:
+        extensions += ('codehilite',)
+
+    return _markdown_converter(extensions).reset().convert(text)
+
+def _markdown_converter(extensions):
+    """Return a :class:`markdown.Markdown` instance for ``extensions``,
+    created once per thread. Instances are not thread-safe and must be
+    reset between documents.
+    """
+    converters = _markdown_converters.__dict__.setdefault('converters', {})
+    try:
+        converter = converters.get(extensions)
+    except TypeError:
+        # Unhashable extension configuration
+        return markdown.Markdown(extensions=list(extensions))
+    if converter is None:
+        converter = markdown.Markdown(extensions=list(extensions))
+        converters[extensions] = converter
+    return converter
+
+class TemplateCache(object):
+    """Template environments and compiled page templates, shared by the
+    pages of a :class:`FlatPages` instance.
+
+    :param directory: Where templates included from pages are looked for.
+    :param bytecode_directory: Optional directory where Jinja2 bytecode and
+                               Mako modules of included templates are kept.
+    :param size: Maximum number of compiled page templates kept in memory.
+    """
+
+    def __init__(self, directory='.', bytecode_directory=None, size=1000):
+        self.directory = directory
+        self.bytecode_directory = bytecode_directory
+        self.size = size
+        self._lock = threading.Lock()
+        #: dict of (kind, sha1 digest of source): compiled template
+        self._templates = {}
+
+    def __getstate__(self):
+        # Compiled templates can not be pickled, only send the settings.
+        return self.directory, self.bytecode_directory, self.size
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @werkzeug.cached_property
+    def jinja_environment(self):
+        bytecode_cache = None
+        if self.bytecode_directory:
+            if not os.path.isdir(self.bytecode_directory):
+                os.makedirs(self.bytecode_directory)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(
+                self.bytecode_directory)
+        # so `import`, `include` and `extends` can be used
+        return jinja2.Environment(
+            loader=jinja2.FileSystemLoader(self.directory),
+            bytecode_cache=bytecode_cache)
+
+    @werkzeug.cached_property
+    def mako_lookup(self):
+        return mako.lookup.TemplateLookup(
+            directories=[self.directory],
+            module_directory=self.bytecode_directory)
+
+    def get(self, kind, text, compile):
+        """Return the compiled template for ``text``, calling
+        ``compile(text)`` if it is not cached yet.
+        """
+        key = kind, hashlib.sha1(text.encode('utf8')).digest()
+        template = self._templates.get(key)
+        if template is None:
+            template = compile(text)
+            with self._lock:
+                if len(self._templates) >= self.size:
+                    self._templates.popitem()
+                self._templates[key] = template
+        return template
 
-    if 'PygmentsHtmlFormatter' in globals():
-        extensions += ['codehilite']
 
-    return markdown.markdown(text, extensions)
+#: Used by the template renderers when not called from a :class:`FlatPages`
+_default_templates = TemplateCache()
 
-def render_jinja(text, context):
+def render_jinja(text, context, templates=None):
     """Renders `Jinja2`_ templates if available.
 
     .. _Jinja2: http://jinja.pocoo.org/
     """
+    if jinja2 is None:
+        return text
+    templates = templates or _default_templates
     try:
-        from jinja2 import Template, FileSystemLoader
-        tmpl = Template(text)
-        # so `import`, `include` and `extends` can be used
-        tmpl.environment.loader = FileSystemLoader('.')
-        return tmpl.render(**context)
-    except:
+        template = templates.get(
+            'jinja', text, templates.jinja_environment.from_string)
+        return template.render(**context)
+    except jinja2.TemplateError:
         return text
 
-def render_mako(text, context):
+def render_mako(text, context, templates=None):
     """Renders `Mako`_ templates if available.
 
     .. _Mako: http://www.makotemplates.org/
     """
+    if mako is None:
+        return text
+    templates = templates or _default_templates
+
+    def compile(text):
+        return mako.template.Template(text, lookup=templates.mako_lookup)
+
     try:
-        from mako.template import Template
-        return Template(text).render(**context)
-    except:
+        return templates.get('mako', text, compile).render(**context)
+    except mako.exceptions.MakoException:
         return text
 
-def render_string(text, context):
+def render_string(text, context, templates=None):
     """Renders using the built-in string.Template class."""
+    # string.Template does no compilation worth caching.
     try:
-        from string import Template
-        return Template(text).safe_substitute(**context)
-    except:
+        return string.Template(text).safe_substitute(**context)
+    except ValueError:
         return text
 
 
@@ -100,17 +235,66 @@ def pygments_style_defs(style='default'):
     return formatter.get_style_defs('.codehilite')
 
 
+class _PageConfig(object):
+    """Renderers and context shared by many :class:`Page` objects. Equal
+    configurations are interned so that pages only hold one reference.
+    """
+
+    __slots__ = ('html_renderer', 'template_renderer', 'context',
+                 'render_cache', 'keep_meta_yaml', 'timings', '__weakref__')
+
+    #: Configurations in use, by identity of their values
+    _interned = weakref.WeakValueDictionary()
+
+    @classmethod
+    def intern(cls, *values):
+        # The objects in values are kept alive by the interned config, so
+        # their ids are not reused while it is in the dict.
+        key = tuple(map(id, values))
+        config = cls._interned.get(key)
+        if config is None:
+            config = cls()
+            (config.html_renderer, config.template_renderer, config.context,
+             config.render_cache, config.keep_meta_yaml,
+             config.timings) = values
+            cls._interned[key] = config
+        return config
+
+
+#: Coalesces concurrent renderings of the same page
+_renders = SingleFlight()
+
+
+def _config_property(name):
+    def fget(self):
+        return getattr(self._config, name)
+
+    def fset(self, value):
+        values = [getattr(self._config, attr)
+                  for attr in _PageConfig.__slots__[:-1]]
+        values[_PageConfig.__slots__.index(name)] = value
+        self._config = _PageConfig.intern(*values)
+    return property(fget, fset)
+
+
 class Page(object):
     """Simple class to store all necessary information about flatpage.
 
     Main purpose to render pages content with ``html_renderer`` function.
     """
 
-    # Used for generating the "Read More" link
-    more = re.compile('<!--.*more.*-->')
+    __slots__ = ('path', '_meta_yaml', '_meta_digest', '_body',
+                 '_body_loader', '_config', '_meta', '_html', '_intro',
+                 '_mtime', '_etag')
+
+    # Used for generating the "Read More" link. Stops at the end of the
+    # first comment containing "more".
+    more = re.compile('<!--[^>]*?more.*?-->')
 
     def __init__(self, path, meta_yaml, body, html_renderer,
-                                template_renderer, context={}):
+                                template_renderer, context={},
+                                render_cache=None, keep_meta_yaml=True,
+                                timings=None):
         """
         Initialize Page instance.
 
@@ -118,15 +302,37 @@ class Page(object):
         :param meta_yaml: Page meta data in YAML format.
         :param body: Page body.
         :param html_renderer: HTML renderer function.
+        :param render_cache: Optional :class:`~.cache.RenderCache` shared
+                             with other pages and processes.
+        :param keep_meta_yaml: If false, the YAML source is dropped once
+                               parsed.
+        :param timings: Optional :class:`~.timings.Timings` receiving
+                        parsing and rendering times.
         """
         #: Path this pages was obtained from, as in ``pages.get(path)``.
         self.path = path
         #: Content of the pages.
         self._meta_yaml = meta_yaml
-        self.body = body
-        self.html_renderer = html_renderer
-        self.template_renderer = template_renderer
-        self.context = context
+        #: Hash of the YAML source for :attr:`etag`, kept when it is dropped
+        self._meta_digest = None
+        self._body = body
+        #: Callable returning the body, when it is read lazily from disk
+        self._body_loader = None
+        self._config = _PageConfig.intern(html_renderer, template_renderer,
+                                          context, render_cache,
+                                          keep_meta_yaml, timings)
+        # Cached values, see clear_cache()
+        self._meta = None
+        self._html = None
+        self._intro = None
+        #: Modification time of the file, set when loaded by FlatPages
+        self._mtime = None
+        self._etag = None
+
+    html_renderer = _config_property('html_renderer')
+    template_renderer = _config_property('template_renderer')
+    context = _config_property('context')
+    render_cache = _config_property('render_cache')
 
     def __getitem__(self, name):
         """Shortcut for accessing metadata.
@@ -138,6 +344,9 @@ class Page(object):
 
     def __getattr__(self, name):
         """Shortcut for accessing metadata with an attribute."""
+        if name.startswith('__'):
+            # Special methods looked up by eg. pickle or copy
+            raise AttributeError(name)
         return self.meta.get(name)
 
     def __html__(self):
@@ -151,25 +360,167 @@ class Page(object):
         """
         return '<Page %r>' % self.path
 
-    @werkzeug.cached_property
+    def clear_cache(self):
+        """Forget the rendered HTML and intro, and the parsed metadata if
+        its YAML source was kept. They are computed again on next access.
+        """
+        self._html = None
+        self._intro = None
+        if self._meta_yaml is not None:
+            self._meta = None
+
+    @property
+    def body(self):
+        """The unicode source of the page, without the metadata header.
+
+        With ``FLATPAGES_LAZY_BODY`` it is only read from disk when first
+        accessed.
+        """
+        body = self._body
+        if body is None:
+            body = self._body = self._body_loader()
+        return body
+
+    @property
     def html(self):
         """The content of the page, rendered as HTML by the configured
         renderer.
+
+        When several threads need it at the same time, only one renders the
+        page while the others wait.
         """
-        body = self.template_renderer(self.body, self.context)
-        return self.html_renderer(body)
+        html = self._html
+        if html is None:
+            html = _renders.run((id(self), 'html'), self._render_html)
+        return html
 
-    @werkzeug.cached_property
+    @property
     def intro(self):
-        intro = re.split(Page.more, self.body)[0]
-        intro = self.template_renderer(intro, self.context)
-        return self.html_renderer(intro)
+        """The part of the page before the first ``<!-- more -->`` comment,
+        rendered as HTML, or the whole page if there is no such comment.
 
-    @werkzeug.cached_property
+        When the comment is a paragraph of its own, the intro is cut from
+        :attr:`html` without rendering again.
+        """
+        intro = self._intro
+        if intro is None:
+            intro = _renders.run((id(self), 'intro'), self._render_intro)
+        return intro
+
+    def _render_html(self):
+        html = self._html
+        if html is None:
+            # Not rendered by a thread that finished just before this one.
+            html = self._html = self._timed('html', self._render, self.body)
+        return html
+
+    def _render_intro(self):
+        intro = self._intro
+        if intro is None:
+            intro = self._intro = self._timed('intro', self._split_intro)
+        return intro
+
+    def _split_intro(self):
+        body = self.body
+        marker = Page.more.search(body)
+        if marker is None:
+            return self.html
+        start, end = marker.span()
+        head = body[:start]
+        if ((not head.strip() or head.endswith('\n\n')) and
+                body[end:end + 1] in ('', '\n')):
+            # A block of its own: look for it at the start of a line in the
+            # rendered page, where it is not inside a paragraph.
+            html = self.html
+            text = marker.group()
+            position = html.find(text)
+            after = position + len(text)
+            if (position != -1 and html[position - 1:position] in ('', '\n')
+                    and html[after:after + 1] in ('', '\n')):
+                return html[:position].rstrip()
+        return self._render(head)
+
+    def _timed(self, event, function, *args):
+        """Call ``function`` and record its run time as ``event``, if
+        timings are enabled.
+        """
+        timings = self._config.timings
+        if timings is None or not timings.enabled:
+            return function(*args)
+        start = clock()
+        result = function(*args)
+        timings.record(event, clock() - start, self.path)
+        return result
+
+    def _render(self, text):
+        """Render ``text`` with the template then the HTML renderer,
+        through the persistent render cache if there is one.
+        """
+        config = self._config
+        cache = config.render_cache
+        if cache is not None:
+            key = cache.key(text, renderer_signature(
+                config.html_renderer, config.template_renderer,
+                config.context))
+            html = cache.get(key)
+            if html is not None:
+                return html
+        html = config.template_renderer(text, config.context)
+        html = config.html_renderer(html)
+        if cache is not None:
+            cache.set(key, html)
+        return html
+
+    @property
     def meta(self):
         """A dict of metadata parsed as YAML from the header of the file.
         """
-        meta = yaml.safe_load(self._meta_yaml)
+        meta = self._meta
+        if meta is None:
+            meta = self._meta = self._timed('meta', self._parse_meta)
+            if not self._config.keep_meta_yaml:
+                self._drop_meta_yaml()
+        return meta
+
+    def _drop_meta_yaml(self):
+        """Forget the YAML source once parsed, but keep its hash for
+        :attr:`etag`.
+        """
+        meta_yaml = self._meta_yaml
+        if meta_yaml is not None:
+            self._meta_digest = RenderCache.key(meta_yaml)
+            self._meta_yaml = None
+
+    @property
+    def etag(self):
+        """A hash of the source of the page and of its renderers
+        configuration, usable as an HTTP entity tag. It is the same in every
+        process serving the same page with the same configuration.
+        """
+        etag = self._etag
+        if etag is None:
+            config = self._config
+            meta_digest = self._meta_digest
+            if meta_digest is None:
+                meta_digest = RenderCache.key(self._meta_yaml or u'')
+            etag = self._etag = RenderCache.key(
+                meta_digest, self.body, renderer_signature(
+                    config.html_renderer, config.template_renderer,
+                    config.context))
+        return etag
+
+    @property
+    def last_modified(self):
+        """The modification time of the page file as a naive UTC
+        :class:`~datetime.datetime`, or ``None`` if unknown.
+        """
+        if self._mtime is None:
+            return None
+        # HTTP dates have no fractional seconds.
+        return datetime.datetime.utcfromtimestamp(int(self._mtime))
+
+    def _parse_meta(self):
+        meta = yaml.load(self._meta_yaml, Loader=_yaml_loader)
         # YAML documents can be any type but we want a dict
         # eg. yaml.safe_load('') -> None
         #     yaml.safe_load('- 1\n- a') -> [1, 'a']
@@ -183,11 +534,75 @@ class Page(object):
         return meta
 
 
+class _BundledPage(Page):
+    """A page read on demand from a :class:`~.bundle.Bundle`, with its
+    metadata already parsed and its HTML already rendered.
+    """
+
+    __slots__ = ('_bundle', '_offset', '_size')
+
+    @property
+    def body(self):
+        body = self._body
+        if body is None:
+            body = self._body = self._bundle.read(self._offset, BODY)
+        return body
+
+    @property
+    def html(self):
+        html = self._html
+        if html is None:
+            html = self._html = self._bundle.read(self._offset, HTML)
+        return html
+
+    @property
+    def intro(self):
+        intro = self._intro
+        if intro is None:
+            intro = self._intro = self._bundle.read(self._offset, INTRO)
+        return intro
+
+    def _parse_meta(self):
+        return self._bundle.read_meta(self._offset, self._size)
+
+
+class _SharedPage(_BundledPage):
+    """A page that does not keep its body and HTML, but reads them from the
+    memory-mapped :class:`~.bundle.Bundle` on each access, so that processes
+    using the same bundle share one copy. See ``FLATPAGES_BUNDLE_SHARED``.
+    """
+
+    __slots__ = ()
+
+    @property
+    def body(self):
+        return self._bundle.read(self._offset, BODY)
+
+    @property
+    def html(self):
+        return self._bundle.read(self._offset, HTML)
+
+    @property
+    def intro(self):
+        return self._bundle.read(self._offset, INTRO)
+
+
 class PageList(list):
     """A page container that allows to filter and order pages."""
 
     MINDATE = datetime.date(datetime.MINYEAR, 1, 1)
 
+    #: :class:`~.index.MetaIndex` of the pages this list was derived from,
+    #: used to speed up :meth:`filter`. Pages that are not in it, eg. pages
+    #: reloaded since or appended to the list, are filtered without it.
+    index = None
+
+    def _derive(self, pages):
+        """Return a new :class:`PageList` sharing the index of this one."""
+        result = PageList(pages)
+        result.index = self.index
+        return result
+
     def order_by(self, key):
         """Returns pages sorted by ``key``.
 
@@ -200,9 +615,9 @@ class PageList(list):
             rev = False
 
         def get_meta(page):
-            return page[key] if key in page.meta else self.MINDATE
+            return _sort_key(page, key)
 
-        return PageList(sorted(self, reverse=rev, key=get_meta))
+        return self._derive(sorted(self, reverse=rev, key=get_meta))
 
     def filter(self, negate=False, *args, **kwargs):
         """Returns pages matching the specified filters.
@@ -217,35 +632,293 @@ class PageList(list):
         *OR* the title is 'Hello'.
         >>> pages.filter(created__exists=True, title='Hello')
 
-        If you want to AND, just chain multiple filter()s together.
-        >>> pages.filter(created__exists=True).filter(title='Hello')
+        If you want to AND, use :meth:`filter_all`.
+        >>> pages.filter_all(created__exists=True, title='Hello')
+
+        With ``negate``, returns pages that do not match at least one of the
+        filters.
         """
-        _filters = []
-        filtered = PageList()
-        for field, value in kwargs.iteritems():
-            try:
-                field_name, condition = field.split('__', 1)
-            except ValueError:
-                field_name = field
-                condition = 'exact'
-            else:
-                # workaround for reserved word
-                if condition == 'in':
-                    condition = 'in_'
-            _filters.append((field_name, condition, value))
+        if negate:
+            return self._select(_all_filters(kwargs), negate=True)
+        return self.filter_any(**kwargs)
+
+    def filter_any(self, **kwargs):
+        """Returns pages matching at least one of the specified filters,
+        like :meth:`filter`.
+        """
+        if not kwargs:
+            return self._derive(())
+        return self._select(Q(**kwargs))
+
+    def filter_all(self, **kwargs):
+        """Returns pages matching all of the specified filters. This is the
+        same as chaining :meth:`filter` calls with one filter each, without
+        building the intermediate lists.
+        """
+        return self._select(_all_filters(kwargs))
+
+    def render(self, field='html', executor=None):
+        """Render the :attr:`~Page.html` or :attr:`~Page.intro` of the
+        pages that do not have it in cache yet, and keep it in their cache.
+        Use this before showing many pages that may not be rendered, eg. in
+        a listing::
+
+            {% for page in pages.render('intro', flatpages.executor) %}
+
+        :param field: ``'html'`` or ``'intro'``.
+        :param executor: An :class:`~.executor.Executor`, usually
+                         :attr:`FlatPages.executor`. If its kind is
+                         ``'process'``, pages are rendered in parallel in
+                         its pool of processes, with both fields in one pass.
+                         Otherwise they are rendered in the calling thread.
+        :return: this list.
+
+        The pool of processes is started on first use. Forking a threaded
+        server is not safe: use it once before serving requests.
+        """
+        if field not in ('html', 'intro'):
+            raise ValueError("Unknown field '%s'" % field)
+        slot = '_' + field
+        pending = []
+        seen = set()
         for page in self:
-            for filt in _filters:
-                field, cond, val = filt
-                try:
-                    result = getattr(filters, cond)(page, field, val)
-                except (AttributeError, TypeError):
-                    raise ValueError("Unknown operator '%s'" % cond)
-                else:
-                    if negate:
-                        result = not result
-                    if result and page not in filtered:
-                        filtered.append(page)
-        return filtered
+            if (getattr(page, slot) is None and page not in seen and
+                    not isinstance(page, _BundledPage)):
+                seen.add(page)
+                pending.append(page)
+        if executor is None or executor.kind == 'thread' or len(pending) < 2:
+            for page in pending:
+                getattr(page, field)
+            return self
+        results = executor.map(_prerender_file, map(_render_job, pending))
+        for page, result in itertools.izip(pending, results):
+            _store_rendered(page, result)
+        return self
+
+    def _select(self, condition, negate=False):
+        """Returns pages matching the :class:`Q` ``condition``, or not
+        matching it with ``negate``, in order and without duplicates.
+        """
+        predicate = condition._predicate(self.index)
+        selected = self._derive(())
+        append = selected.append
+        seen = set()
+        add = seen.add
+        for page in self:
+            matches = predicate(page)
+            if negate:
+                matches = not matches
+            if matches and page not in seen:
+                add(page)
+                append(page)
+        return selected
+
+
+class _SortedPageView(object):
+    """A sorted sequence of pages sharing a cached ordering of
+    :class:`FlatPages` or :class:`CombinedPages`, iterated without copying
+    it, eg. by :class:`Query`.
+    """
+
+    def __init__(self, entries, reverse, index=None):
+        #: Shared, never modified list of (sort key, path, page) tuples
+        self._entries = entries
+        self._reverse = reverse
+        #: See :attr:`PageList.index`
+        self.index = index
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        entries = reversed(self._entries) if self._reverse else self._entries
+        for entry in entries:
+            yield entry[2]
+
+    def _list(self):
+        result = PageList(self)
+        result.index = self.index
+        return result
+
+
+class Q(object):
+    """A condition on pages for :meth:`Query.filter`, with the same
+    arguments as :meth:`PageList.filter`: ``Q(tags__contains='python')``.
+    Several keyword arguments are joined using OR, like in
+    :meth:`PageList.filter`. ``Q()`` matches all pages.
+
+    Conditions are combined with ``&`` (and), ``|`` (or) and ``~`` (not)::
+
+        Q(tags__contains='python') & ~Q(draft=True)
+    """
+
+    def __init__(self, **kwargs):
+        self._operator = 'filters'
+        self._operands = _parse_filters(kwargs)
+
+    @classmethod
+    def _combine(cls, operator, operands):
+        condition = cls()
+        condition._operator = operator
+        condition._operands = operands
+        return condition
+
+    def __and__(self, other):
+        return Q._combine('and', (self, other))
+
+    def __or__(self, other):
+        return Q._combine('or', (self, other))
+
+    def __invert__(self):
+        return Q._combine('not', (self,))
+
+    def _predicate(self, index):
+        """Return a function of a page returning whether it matches,
+        using the :class:`~.index.MetaIndex` ``index`` if not ``None``.
+        """
+        operator = self._operator
+        if operator == 'not':
+            predicate = self._operands[0]._predicate(index)
+            return lambda page: not predicate(page)
+        if operator == 'filters':
+            if not self._operands:
+                return lambda page: True
+            predicates = [_filter_predicate(index, *filt)
+                          for filt in self._operands]
+            operator = 'or'
+        else:
+            predicates = [operand._predicate(index)
+                          for operand in self._operands]
+        if len(predicates) == 1:
+            return predicates[0]
+        if operator == 'and':
+            def predicate(page):
+                for test in predicates:
+                    if not test(page):
+                        return False
+                return True
+        else:
+            def predicate(page):
+                for test in predicates:
+                    if test(page):
+                        return True
+                return False
+        return predicate
+
+
+class Query(object):
+    """A lazy query on pages, as returned by :meth:`FlatPages.query`.
+
+    Methods return new queries and do not look at any page. Pages are only
+    filtered when the query is iterated on, indexed or sliced, or passed to
+    :func:`len`, and only until enough pages were found::
+
+        # The 5 most recent pages tagged "python", without building a list
+        # of all pages with that tag.
+        pages.query(tags__contains='python').order_by('-date').limit(5)
+
+    :param source: :class:`FlatPages`, :class:`PageList` or any iterable of
+                   :class:`Page` objects.
+    """
+
+    def __init__(self, source, condition=None, ordering=None, limit=None):
+        self._source = source
+        self._condition = condition
+        self._ordering = ordering
+        self._limit = limit
+
+    def _copy(self, **changes):
+        arguments = dict(condition=self._condition, ordering=self._ordering,
+                         limit=self._limit)
+        arguments.update(changes)
+        return Query(self._source, **arguments)
+
+    def filter(self, *conditions, **kwargs):
+        """Return a query for the pages of this one that match all
+        given :class:`Q` conditions, and ``kwargs`` as in
+        :meth:`PageList.filter`.
+        """
+        if kwargs:
+            conditions += (Q(**kwargs),)
+        if self._condition is not None:
+            conditions = (self._condition,) + conditions
+        return self._copy(condition=_conjunction(conditions))
+
+    def exclude(self, *conditions, **kwargs):
+        """Return a query for the pages of this one that do not match the
+        conditions, as given to :meth:`filter`.
+        """
+        if kwargs:
+            conditions += (Q(**kwargs),)
+        return self.filter(~(_conjunction(conditions) or Q()))
+
+    def order_by(self, key):
+        """Return a query for the same pages, sorted as in
+        :meth:`FlatPages.order_by`.
+        """
+        return self._copy(ordering=key)
+
+    def limit(self, count):
+        """Return a query for at most the first ``count`` pages."""
+        if self._limit is not None:
+            count = min(count, self._limit)
+        return self._copy(limit=count)
+
+    def first(self):
+        """Return the first matching page, or ``None``."""
+        for page in self.limit(1):
+            return page
+        return None
+
+    def __iter__(self):
+        if self._limit == 0:
+            return iter(())
+        source = self._source
+        if isinstance(source, (FlatPages, CombinedPages)):
+            if self._ordering is not None:
+                # Stream from the cached ordering.
+                source = source._ordering(self._ordering)
+        elif self._ordering is not None:
+            if not hasattr(source, 'order_by'):
+                source = PageList(source)
+            source = source.order_by(self._ordering)
+        pages = iter(source)
+        if self._condition is not None:
+            index = self._index()
+            pages = itertools.ifilter(self._condition._predicate(index),
+                                      pages)
+        if self._limit is not None:
+            pages = itertools.islice(pages, self._limit)
+        return pages
+
+    def _index(self):
+        source = self._source
+        if isinstance(source, (FlatPages, CombinedPages)):
+            return source._meta_index()
+        if isinstance(source, PageList):
+            return source.index
+        return None
+
+    def __len__(self):
+        count = 0
+        for page in self:
+            count += 1
+        return count
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.start, item.stop, item.step
+            if ((start or 0) < 0 or (stop or 0) < 0 or (step or 1) < 0):
+                return PageList(self)[item]
+            return PageList(itertools.islice(self, start, stop, step))
+        if item < 0:
+            return list(self)[item]
+        for page in itertools.islice(self, item, None):
+            return page
+        raise IndexError('page index out of range')
+
+    def __repr__(self):
+        return '<Query %r>' % list(self)
 
 
 class FlatPages(object):
@@ -261,17 +934,82 @@ class FlatPages(object):
         ('template_context', {}),
         ('markdown_extensions', ['codehilite']),
         ('auto_reload', 'if debug'),
+        ('render_cache', None),
+        ('render_cache_size', 64 * 1024 * 1024),
+        ('template_cache_dir', None),
+        ('lazy_body', False),
+        ('keep_meta_yaml', True),
+        ('timings', False),
+        ('bundle', None),
+        ('eager_meta', False),
+        ('bundle_shared', False),
+        ('search_fields', ['title']),
+        ('search_index', None),
+        ('async_workers', None),
+        ('async_executor', 'thread'),
     )
 
-    def __init__(self, app=None):
+    #: When reloaded pages change the search index, the
+    #: ``FLATPAGES_SEARCH_INDEX`` file is written at most once in this many
+    #: seconds. Changes left are written when the interpreter exits.
+    search_save_interval = 60
+
+    def __init__(self, app=None, name=None):
         """Initialize FlatPages extension.
 
         :param app: your application. Can be omited if you call
                     :meth:`init_app` later.
         :type app: Flask instance
+        :param name: Name of this instance when an application has several,
+                     eg. with different roots. Their configuration values
+                     are prefixed with the upper-cased name:
+                     ``FLATPAGES_BLOG_ROOT`` for ``name='blog'``.
         """
-        #: dict of filename: (page object, mtime when loaded)
+        #: Name of the instance, or ``None``
+        self.name = name
+        if name is None:
+            self.config_prefix = 'FLATPAGES'
+        else:
+            self.config_prefix = 'FLATPAGES_%s' % name.upper()
+        #: dict of filename: (page object, fingerprint of the file as given
+        #: by :func:`_fingerprint`, SHA-1 digest of its content or ``None``)
         self._file_cache = {}
+        #: :class:`~.cache.RenderCache` for the current configuration
+        self._render_cache = None
+        #: :class:`TemplateCache` for the current configuration
+        self._templates = None
+        #: dict of template renderer: renderer bound to :attr:`_templates`
+        self._bound_renderers = {}
+        #: :func:`pygmented_markdown` bound to the Markdown extensions of a
+        #: named instance
+        self._markdown_renderer = None
+        #: :class:`~.scanner.Scanner` remembering the state of the root
+        self._scanner = None
+        #: dict of unicode path: page object, updated in place on reload
+        self._page_dict = {}
+        #: :class:`~.watcher.Watcher` when ``FLATPAGES_AUTO_RELOAD`` is
+        #: ``'watch'``
+        self._watcher = None
+        #: Serializes updates of the pages dict
+        self._lock = threading.RLock()
+        #: :class:`~.index.MetaIndex` of all pages, built on first filter
+        self._index = None
+        #: dict of meta key: sorted list of (sort key, path, page), built on
+        #: first :meth:`order_by` and replaced by updated copies on reload
+        self._orderings = {}
+        #: :class:`~.search.SearchIndex` of all pages, built on first search
+        self._search = None
+        #: :func:`time.time` of the last write of the search index file
+        self._search_saved = 0
+        #: :class:`~.timings.Timings` of page operations, enabled by
+        #: ``FLATPAGES_TIMINGS``
+        self.timings = Timings()
+        #: :class:`~.bundle.Bundle` the pages were loaded from, if
+        #: ``FLATPAGES_BUNDLE`` is set
+        self._bundle = None
+        #: :class:`~.executor.Executor` of the ``*_async`` methods, created
+        #: on first use
+        self._executor = None
 
         if app:
             self.init_app(app)
@@ -279,7 +1017,8 @@ class FlatPages(object):
     def __iter__(self):
         """Iterate on all :class:`Page` objects.
         """
-        return self._pages.itervalues()
+        # A list copy, as the dict can be patched by another thread.
+        return iter(self._pages.values())
 
     def init_app(self, app):
         """Used to initialize an application, useful for passing an app later
@@ -289,16 +1028,34 @@ class FlatPages(object):
         :type app: Flask instance
         """
         # Store default config to application
+        prefix = self.config_prefix
         for key, value in self.default_config:
-            config_key = 'FLATPAGES_%s' % key.upper()
+            config_key = '%s_%s' % (prefix, key.upper())
             app.config.setdefault(config_key, value)
 
-        app.config['FLATPAGES_HTML_RENDERER'].markdown_extensions = \
-                            app.config.get('FLATPAGES_MARKDOWN_EXTENSIONS', [])
+        extensions = tuple(app.config.get(prefix + '_MARKDOWN_EXTENSIONS', []))
+        if self.name is None:
+            app.config[prefix + '_HTML_RENDERER'].markdown_extensions = \
+                extensions
+        else:
+            # Do not change the renderer shared with other instances.
+            self._markdown_renderer = functools.partial(
+                pygmented_markdown, extensions=extensions)
 
         # Register function to forget all pages if necessary
         app.before_request(self._conditional_auto_reset)
 
+        self.timings.enabled = bool(app.config[prefix + '_TIMINGS'])
+
+        cli = getattr(app, 'cli', None)
+        if cli is not None:
+            # Flask 0.11 and later
+            self._register_command(cli)
+
+        extensions = getattr(app, 'extensions', None)
+        if extensions is not None:
+            extensions.setdefault('flatpages', {})[self.name] = self
+
         # And finally store application to current instance
         self.app = app
 
@@ -307,7 +1064,7 @@ class FlatPages(object):
 
         :param key: Lowercase config key from :attr:`default_config` tuple
         """
-        return self.app.config['FLATPAGES_%s' % key.upper()]
+        return self.app.config['%s_%s' % (self.config_prefix, key.upper())]
 
     def get(self, path, default=None):
         """Returns the :class:`Page` object at ``path``, or ``default`` if
@@ -329,30 +1086,271 @@ class FlatPages(object):
             flask.abort(404)
         return page
 
+    def render_page_response(self, path, render=None):
+        """Return a response for the page at ``path`` with its
+        :attr:`~Page.etag` and :attr:`~Page.last_modified`, or raise Flask's
+        404 error if there is no such page.
+
+        Conditional requests are answered with ``304 Not Modified`` without
+        rendering the page.
+
+        :param render: Function taking the :class:`Page` and returning the
+                       response body, eg. calling
+                       :func:`~flask.render_template`. Defaults to the HTML
+                       of the page. The ETag does not cover templates used
+                       here.
+        """
+        return _page_response(self.get_or_404(path), render)
+
+    def get_async(self, path, callback=None, error_callback=None):
+        """Like :meth:`get`, in a background thread so that loading pages
+        from the filesystem does not block the caller.
+
+        Concurrent calls for the same path share one load.
+
+        :param callback: Called with the :class:`Page` or ``None`` when it
+                         is loaded, so that event-driven servers do not need
+                         to wait for the result.
+        :param error_callback: Called with the exception if loading fails.
+        :return: a :class:`~multiprocessing.pool.AsyncResult`: call its
+                 ``get`` method for the :class:`Page` or ``None``.
+
+        Callbacks are called in a background thread, before the result is
+        ready.
+        """
+        return self._get_executor().submit(('get', path), self.get, (path,),
+                                           callback, error_callback)
+
+    def render_async(self, page, callback=None, error_callback=None):
+        """Render ``page`` in the background, in a process if
+        ``FLATPAGES_ASYNC_EXECUTOR`` is ``'process'``. The HTML is kept in
+        the page as with :attr:`Page.html`.
+
+        Concurrent calls for the same page share one rendering.
+
+        :param callback: Called with the HTML, see :meth:`get_async`.
+        :param error_callback: See :meth:`get_async`.
+        :return: a :class:`~multiprocessing.pool.AsyncResult` of the HTML.
+        """
+        return self._get_executor().submit(
+            ('render', id(page)), self._render_page, (page,), callback,
+            error_callback)
+
+    def filter_async(self, *args, **kwargs):
+        """Like :meth:`filter`, in a background thread.
+
+        The ``callback`` and ``error_callback`` keyword arguments are used
+        as in :meth:`get_async`, not as filters.
+
+        :return: a :class:`~multiprocessing.pool.AsyncResult` of the
+                 :class:`PageList`.
+        """
+        callback = kwargs.pop('callback', None)
+        error_callback = kwargs.pop('error_callback', None)
+        return self._get_executor().submit(
+            None, functools.partial(self.filter, *args, **kwargs), (),
+            callback, error_callback)
+
+    def order_by_async(self, key, callback=None, error_callback=None):
+        """Like :meth:`order_by`, in a background thread.
+
+        Each call gets its own :class:`PageList`, but pages are only sorted
+        once for each key, as with :meth:`order_by`.
+
+        :param callback: See :meth:`get_async`.
+        :param error_callback: See :meth:`get_async`.
+        :return: a :class:`~multiprocessing.pool.AsyncResult` of the
+                 :class:`PageList`.
+        """
+        return self._get_executor().submit(None, self.order_by, (key,),
+                                           callback, error_callback)
+
+    @property
+    def executor(self):
+        """The :class:`~.executor.Executor` of the ``*_async`` methods,
+        configured with ``FLATPAGES_ASYNC_WORKERS`` and
+        ``FLATPAGES_ASYNC_EXECUTOR``. See :meth:`PageList.render`.
+        """
+        return self._get_executor()
+
+    def stop_executor(self):
+        """Wait for pending ``*_async`` calls and stop the background
+        threads and processes. They are started again when needed.
+        """
+        executor = self._executor
+        self._executor = None
+        if executor is not None:
+            executor.close()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = Executor(self.config('async_workers'),
+                                          self.config('async_executor'))
+            return self._executor
+
+    def _render_page(self, page):
+        """Implementation of :meth:`render_async`."""
+        executor = self._executor
+        if (page._html is not None or isinstance(page, _BundledPage) or
+                executor is None or executor.kind == 'thread'):
+            return page.html
+        result = executor.call(_prerender_file, _render_job(page))
+        _store_rendered(page, result)
+        return page._html
+
     def reload(self):
         """Forget all pages.
 
         All pages will be reloaded next time they're accessed.
         """
-        try:
-            # This will "unshadow" the cached_property.
-            # The property will be re-executed on next access.
-            del self.__dict__['_pages']
-        except KeyError:
-            pass
+        # Wait for a load in progress, so that it does not cache pages
+        # after they were forgotten.
+        with self._lock:
+            # The pages are loaded again on next access.
+            self.__dict__.pop('_pages', None)
 
     def order_by(self, key):
-        #TODO: Implement caching
-        return PageList(self._pages.itervalues()).order_by(key)
+        """Returns a :class:`PageList` of all pages sorted by the ``key``
+        metadata, in descending order if it starts with ``-``. See
+        :meth:`PageList.order_by`.
+
+        Orderings are cached for each key and updated when pages are
+        reloaded, rather than sorting again.
+        """
+        return self._ordering(key)._list()
+
+    def _ordering(self, key):
+        """Return a :class:`_SortedPageView` of the cached ordering for
+        ``key``, sorting pages if needed.
+        """
+        timings = self.timings
+        start = timings.enabled and clock()
+        reverse = key.startswith('-')
+        if reverse:
+            key = key[1:]
+        pages = self._pages
+        with self._lock:
+            entries = self._orderings.get(key)
+            if entries is None:
+                entries = sorted((_sort_key(page, key), path, page)
+                                 for path, page in pages.iteritems())
+                self._orderings[key] = entries
+            view = _SortedPageView(entries, reverse, self._index)
+        if start:
+            timings.record('order_by', clock() - start)
+        return view
 
     def filter(self, *args, **kwargs):
-        #TODO: Implement caching
-        return PageList(self._pages.itervalues()).filter(*args, **kwargs)
+        """Returns pages matching the specified filters. See
+        :meth:`PageList.filter`. Indexes of the metadata are built on first
+        use and kept up to date when pages are reloaded.
+        """
+        return self._filter('filter', args, kwargs)
+
+    def filter_any(self, **kwargs):
+        """Returns pages matching at least one of the specified filters.
+        See :meth:`PageList.filter_any`.
+        """
+        return self._filter('filter_any', (), kwargs)
+
+    def filter_all(self, **kwargs):
+        """Returns pages matching all of the specified filters. See
+        :meth:`PageList.filter_all`.
+        """
+        return self._filter('filter_all', (), kwargs)
+
+    def _filter(self, method, args, kwargs):
+        """Call a filter method of :class:`PageList` on all pages, with the
+        metadata index.
+        """
+        timings = self.timings
+        start = timings.enabled and clock()
+        pages = self._pages
+        with self._lock:
+            result = PageList(pages.values())
+            result.index = self._meta_index()
+        result = getattr(result, method)(*args, **kwargs)
+        if start:
+            timings.record('filter', clock() - start)
+        return result
 
     def exclude(self, *args, **kwargs):
         """A negated filter."""
         return self.filter(negate=True, *args, **kwargs)
 
+    def query(self, *conditions, **kwargs):
+        """Return a lazy :class:`Query` on all pages, filtered as in
+        :meth:`Query.filter` if arguments are given.
+        """
+        return Query(self).filter(*conditions, **kwargs)
+
+    def search(self, query, limit=None):
+        """Full-text search in the body and the ``FLATPAGES_SEARCH_FIELDS``
+        metadata of pages. Pages must contain all words of ``query``, and
+        words ending with ``*`` match any word starting with them.
+
+        The index is built on first use and updated when pages are
+        reloaded. It is saved to ``FLATPAGES_SEARCH_INDEX`` if set.
+
+        :return: a :class:`PageList` of at most ``limit`` pages, best
+                 matches first.
+        """
+        pages = self._pages
+        with self._lock:
+            ranked = self._search_index().search(query, limit)
+            return PageList(pages[path] for path, score in ranked)
+
+    def _search_index(self):
+        """Return the :class:`~.search.SearchIndex` of all pages, building
+        it or loading it from ``FLATPAGES_SEARCH_INDEX`` if needed.
+        """
+        pages = self._pages
+        with self._lock:
+            search = self._search
+            if search is None:
+                search = SearchIndex(self.config('search_fields'))
+                filename = self._search_index_filename()
+                if filename:
+                    search.load(filename)
+                search.update(pages)
+                self._search = search
+                if filename:
+                    _unsaved_search_indexes[self] = True
+                    self._save_search_index(force=True)
+            return search
+
+    def _search_index_filename(self):
+        filename = self.config('search_index')
+        if filename:
+            return os.path.join(self.app.root_path, filename)
+        return None
+
+    def _save_search_index(self, force=False):
+        """Write the search index to ``FLATPAGES_SEARCH_INDEX`` if it
+        changed, unless it was written less than
+        :attr:`search_save_interval` seconds ago and ``force`` is false.
+        """
+        search = self._search
+        filename = self._search_index_filename()
+        if search is None or not filename or not search.changed:
+            return
+        now = time.time()
+        if not force and now - self._search_saved < self.search_save_interval:
+            return
+        search.save(filename)
+        self._search_saved = now
+
+    def _meta_index(self):
+        """Return the :class:`~.index.MetaIndex` of all pages, building it
+        if needed.
+        """
+        pages = self._pages
+        with self._lock:
+            if self._index is None:
+                self._index = MetaIndex(pages.itervalues())
+            return self._index
+
     @property
     def root(self):
         """Full path to the directory where pages are looked for.
@@ -362,77 +1360,925 @@ class FlatPages(object):
         """
         return os.path.join(self.app.root_path, self.config('root'))
 
+    def render_cache(self):
+        """Return the persistent :class:`~.cache.RenderCache`, or ``None``
+        if ``FLATPAGES_RENDER_CACHE`` is not set.
+        """
+        filename = self.config('render_cache')
+        if not filename:
+            return None
+        filename = os.path.join(self.app.root_path, filename)
+        cache = self._render_cache
+        if cache is None or cache.filename != filename:
+            cache = self._render_cache = RenderCache(filename)
+        cache.max_size = self.config('render_cache_size')
+        return cache
+
     def _conditional_auto_reset(self):
         """Reset if configured to do so on new requests.
         """
         auto = self.config('auto_reload')
+        if auto == 'watch' and not self.config('bundle'):
+            self._apply_watched_changes()
+            return
         if auto == 'if debug':
             auto = self.app.debug
         if auto:
             self.reload()
 
+    def stop_watching(self):
+        """Stop the background thread started when ``FLATPAGES_AUTO_RELOAD``
+        is ``'watch'``. It is started again the next time pages are loaded.
+        """
+        watcher = self._watcher
+        self._watcher = None
+        if watcher is not None:
+            watcher.stop()
+
+    def _start_watching(self, root):
+        """Make sure a watcher is running for ``root``."""
+        watcher = self._watcher
+        if watcher is not None and watcher.root == root and watcher.running:
+            return
+        self.stop_watching()
+        watcher = make_watcher(root)
+        watcher.start()
+        self._watcher = watcher
+
+    def _apply_watched_changes(self):
+        """Reload only the pages affected by changes seen by the watcher.
+        """
+        if '_pages' not in self.__dict__:
+            # Everything is scanned on next access anyway.
+            return
+        watcher = self._watcher
+        if watcher is None or not watcher.running:
+            # Eg. in a process forked after pages were loaded, where the
+            # thread of the watcher does not exist. Changes may have been
+            # missed: scan, which starts a new watcher first.
+            with self._lock:
+                self._walk()
+            return
+        changes = watcher.pop_changes()
+        if changes is None:
+            return
+        with self._lock:
+            if changes is True:
+                # Events were lost, fall back to a full incremental scan.
+                self._walk()
+                return
+            directories, files = changes
+            added_files, removed_files = self._scanner.update(directories)
+            known = self._scanner.files
+            filenames = set(added_files)
+            filenames.update(name for name in files if name in known)
+            self._patch(added_files, removed_files, filenames)
+
     def _load_file(self, path, filename):
         """Load file from file system and put it to cached dict as
-        :class:`Path` and `mtime` tuple.
+        :class:`Path`, fingerprint and digest tuple.
+
+        The file is only read if its modification time, size or inode
+        changed. It is only parsed again if its content changed, so that
+        files touched but not modified keep their :class:`Page` object and
+        its rendered HTML.
         """
-        mtime = os.path.getmtime(filename)
+        timings = self.timings
+        start = timings.enabled and clock()
+        stat = os.stat(filename)
+        fingerprint = _fingerprint(stat)
         cached = self._file_cache.get(filename)
-        if cached and cached[1] == mtime:
+        if cached and fingerprint is not None and cached[1] == fingerprint:
             page = cached[0]
+            event = 'load_file.hit'
         else:
-            with open(filename) as fd:
-                content = fd.read().decode(self.config('encoding'))
-            page = self._parse(content, path)
-            self._file_cache[filename] = page, mtime
+            page = None
+            encoding = self.config('encoding')
+            if self.config('lazy_body') and _is_ascii_compatible(encoding):
+                # Reading the whole file to hash it would defeat the point.
+                digest = None
+                new = self._parse_header(filename, path, stat.st_mtime,
+                                         encoding)
+            else:
+                with open(filename) as fd:
+                    content = fd.read()
+                digest = hashlib.sha1(content).digest()
+                if cached and cached[2] == digest:
+                    # Touched but not modified
+                    page = cached[0]
+                else:
+                    new = self._parse(content.decode(encoding), path)
+            if page is None:
+                event = 'load_file.miss'
+                page = new
+                if cached:
+                    _reuse_meta(cached[0], page)
+                if self.config('eager_meta'):
+                    page.meta
+            else:
+                event = 'load_file.hit'
+            page._mtime = stat.st_mtime
+            self._file_cache[filename] = page, fingerprint, digest
+        if start:
+            timings.record(event, clock() - start, path)
         return page
 
-    @werkzeug.cached_property
-    def _pages(self):
-        """Walk the page root directory an return a dict of unicode path:
-        page object.
+    def _parse_header(self, filename, path, mtime, encoding):
+        """Read only the metadata header of a page file, and let the body be
+        read on first use.
+
+        :return: initialized :class:`Page` instance.
         """
-        def _walk(directory, path_prefix=()):
-            """Walk over directory and find all possible flatpages, files which
-            ended with ``FLATPAGES_EXTENSION`` value.
-            """
-            for name in os.listdir(directory):
-                full_name = os.path.join(directory, name)
+        lines = []
+        with open(filename, 'rb') as fd:
+            # Read lines until an empty line is encountered.
+            for line in iter(fd.readline, ''):
+                line = line.decode(encoding)
+                if not line.strip():
+                    break
+                if line.endswith(u'\n'):
+                    line = line[:-1]
+                lines.append(line)
+            offset = fd.tell()
+        page = self._make_page(path, u'\n'.join(lines), None)
+        page._body_loader = functools.partial(
+            _read_body, filename, offset, mtime, encoding)
+        return page
 
-                if os.path.isdir(full_name):
-                    _walk(full_name, path_prefix + (name,))
-                elif name.endswith(extension):
-                    name_without_extension = name[:-len(extension)]
-                    path = u'/'.join(path_prefix + (name_without_extension, ))
-                    pages[path] = self._load_file(path, full_name)
+    def prerender(self, workers=None, executor='process'):
+        """Load, parse and render all pages in parallel, and keep the results
+        in cache. This is meant to be called once at startup, before serving
+        requests. With ``FLATPAGES_BUNDLE``, pages are only loaded from the
+        bundle, where they are already rendered, with their metadata.
 
-        extension = self.config('extension')
-        pages = {}
+        :param workers: Number of workers, defaults to the number of CPUs.
+        :param executor: ``'process'`` for a pool of processes or
+                         ``'thread'`` for a pool of threads. Renderers and the
+                         template context must be picklable with processes.
+        """
+        if self.config('bundle'):
+            for page in self._pages.itervalues():
+                page.meta
+            return
+        self._prerender_files(workers, executor)
+
+    def build_bundle(self, filename=None, workers=None, executor='process'):
+        """Load and render all pages from ``FLATPAGES_ROOT`` and write them
+        to a bundle file. See ``FLATPAGES_BUNDLE``.
+
+        :param filename: Where to write the bundle, relative to the app root
+                         directory. Defaults to ``FLATPAGES_BUNDLE``.
+        :param workers: See :meth:`prerender`.
+        :param executor: See :meth:`prerender`.
+        :return: the number of pages written.
+        """
+        filename = filename or self.config('bundle')
+        if not filename:
+            raise ValueError('No bundle filename given and FLATPAGES_BUNDLE '
+                             'is not set.')
+        filename = os.path.join(self.app.root_path, filename)
+        # Load from the files even if this instance uses a bundle.
+        builder = FlatPages(name=self.name)
+        builder.app = self.app
+        try:
+            builder._prerender_files(workers, executor)
+        finally:
+            builder.stop_watching()
+        return write_bundle(filename, builder._page_dict.itervalues())
+
+    def _register_command(self, cli):
+        """Add a ``flatpages-bundle`` command to the ``flask`` script,
+        suffixed with the name of this instance if any.
+        """
+        import click
+
+        command = 'flatpages-bundle'
+        if self.name is not None:
+            command += '-' + self.name
+
+        @cli.command(command)
+        @click.argument('filename', required=False)
+        @click.option('--workers', type=int,
+                      help='Number of processes, one per CPU by default.')
+        def build_bundle_command(filename, workers):
+            """Build the bundle of pages for FLATPAGES_BUNDLE."""
+            count = self.build_bundle(filename, workers)
+            click.echo('Wrote %d pages.' % count)
+
+    def _prerender_files(self, workers, executor):
+        """Implementation of :meth:`prerender`, from the page files."""
+        with self._lock:
+            scanner = self._get_scanner()
+            added_files, removed_files = scanner.scan()
+            encoding = self.config('encoding')
+            renderers = self._renderers()
+            render_cache = self.render_cache()
+            if render_cache is not None:
+                render_cache = render_cache.filename, render_cache.max_size
+            jobs = []
+            loaded = []
+            for filename, path in scanner.files.iteritems():
+                cached = self._file_cache.get(filename)
+                page = source = None
+                # Before reading: a later change gives another fingerprint.
+                fingerprint = _fingerprint(os.stat(filename))
+                if (cached and fingerprint is not None and
+                        cached[1] == fingerprint):
+                    page = cached[0]
+                    if page._html is not None and page._intro is not None:
+                        continue
+                    source = page._meta_yaml or u'', page.body
+                jobs.append((path, filename, source, encoding) + renderers +
+                            (render_cache,))
+                loaded.append((page, fingerprint, cached))
+
+            if jobs:
+                results = _map_jobs(jobs, workers or _cpu_count(), executor)
+                keep_meta_yaml = self.config('keep_meta_yaml')
+                for (page, fingerprint, cached), result in itertools.izip(
+                        loaded, results):
+                    (path, filename, mtime, digest, meta_yaml, body,
+                     meta, html, intro) = result
+                    if page is None:
+                        if cached and cached[2] == digest:
+                            # Too recent for a fingerprint, but unchanged:
+                            # keep the loaded page and its rendered HTML.
+                            page = cached[0]
+                        else:
+                            page = self._make_page(path, meta_yaml, body)
+                            if cached:
+                                _reuse_meta(cached[0], page)
+                        page._mtime = mtime
+                        # With the digest, files modified too recently to
+                        # have a fingerprint keep this page if unchanged.
+                        self._file_cache[filename] = (page, fingerprint,
+                                                      digest)
+                    if page._meta is None:
+                        page._meta = meta
+                        if not keep_meta_yaml:
+                            page._drop_meta_yaml()
+                    _store_rendered(page, result)
+            self._patch(added_files, removed_files, scanner.files)
+            self.__dict__['_pages'] = self._page_dict
 
-        # Fail if the root is a non-ASCII byte string. Use Unicode.
-        _walk(unicode(self.root))
+    @property
+    def _pages(self):
+        """Scan the page root directory an return a dict of unicode path:
+        page object.
 
-        return pages
+        The dict is cached in ``__dict__`` until :meth:`reload`. Threads
+        accessing it at the same time wait for one of them to load the
+        pages.
+        """
+        pages = self.__dict__.get('_pages')
+        if pages is not None:
+            # Already loaded. Reading without the lock is safe: the cache is
+            # only stored and deleted with it.
+            return pages
+        with self._lock:
+            pages = self.__dict__.get('_pages')
+            if pages is None:
+                if self.config('bundle'):
+                    self._load_bundle()
+                else:
+                    self._walk()
+                # Unlike with a cached property, the result is stored before
+                # releasing the lock: a reload() can not be undone.
+                pages = self.__dict__['_pages'] = self._page_dict
+            return pages
+
+    def _load_bundle(self):
+        """Make the pages dict hold the pages of ``FLATPAGES_BUNDLE``,
+        unless the bundle file was not replaced since it was last loaded.
+        """
+        filename = os.path.join(self.app.root_path, self.config('bundle'))
+        with self._lock:
+            bundle = self._bundle
+            if (bundle is not None and bundle.filename == filename and
+                    bundle.is_current()):
+                return
+            bundle = self._bundle = Bundle(filename)
+            # Pages loaded from files are not used anymore.
+            self.stop_watching()
+            self._scanner = None
+            self._file_cache.clear()
+            self._index = None
+            self._orderings = {}
+            self._search = None
+            pages = self._page_dict
+            pages.clear()
+            config = self._renderers() + (
+                self.render_cache(), self.config('keep_meta_yaml'),
+                self.timings)
+            page_class = (_SharedPage if self.config('bundle_shared')
+                          else _BundledPage)
+            for path, entry in bundle.entries.iteritems():
+                page = page_class(path, None, None, *config)
+                page._bundle = bundle
+                page._offset, page._size, page._mtime, page._etag = entry
+                pages[path] = page
+
+    def _walk(self):
+        """Bring the pages dict up to date with the filesystem.
+
+        Only directories that changed since the previous call are listed
+        again, and only files that changed are parsed again. The pages dict
+        is patched in place.
+
+        :return: a ``(added, removed, modified)`` tuple of sets of paths.
+        """
+        timings = self.timings
+        start = timings.enabled and clock()
+        with self._lock:
+            scanner = self._get_scanner()
+            added_files, removed_files = scanner.scan()
+            result = self._patch(added_files, removed_files, scanner.files)
+        if start:
+            timings.record('walk', clock() - start)
+        return result
+
+    def _get_scanner(self):
+        """Return the :class:`~.scanner.Scanner` for the current
+        configuration, and start the watcher if needed.
+        """
+        # Fail if the root is a non-ASCII byte string. Use Unicode.
+        root = unicode(self.root)
+        extension = self.config('extension')
+        if self.config('auto_reload') == 'watch':
+            # Start before scanning so that no change is missed.
+            self._start_watching(root)
+        scanner = self._scanner
+        if (scanner is None or scanner.root != root or
+                scanner.extension != extension):
+            scanner = self._scanner = Scanner(root, extension)
+            self._bundle = None
+            self._page_dict.clear()
+            self._index = None
+            self._orderings = {}
+            self._search = None
+        return scanner
+
+    def _patch(self, added_files, removed_files, filenames):
+        """Update the pages dict in place: remove pages for
+        ``removed_files``, and load or check for modification
+        ``filenames``, which include ``added_files``. All arguments are dicts
+        or sets of filenames, the first two map them to paths.
+
+        :return: a ``(added, removed, modified)`` tuple of sets of paths.
+        """
+        pages = self._page_dict
+        files = self._scanner.files
+        added = set()
+        removed = set()
+        modified = set()
+        # Orderings lists are shared with views: update copies.
+        copied = set()
+        for filename, path in removed_files.iteritems():
+            self._file_cache.pop(filename, None)
+            old = pages.pop(path, None)
+            if old is not None:
+                self._replace(path, old, None, copied)
+            removed.add(path)
+        for filename in filenames:
+            path = files[filename]
+            page = self._load_file(path, filename)
+            old = pages.get(path)
+            if old is page:
+                continue
+            if filename in added_files:
+                added.add(path)
+            else:
+                modified.add(path)
+            pages[path] = page
+            self._replace(path, old, page, copied)
+        self._save_search_index()
+        return added, removed, modified
+
+    def _replace(self, path, old, new, copied):
+        """Update the index and cached orderings for page ``old`` being
+        replaced by ``new`` at ``path``. Either can be ``None``. ``copied``
+        is the set of keys of orderings already copied in this update.
+
+        Orderings and indexes that can not be updated, eg. because the
+        metadata of ``new`` is invalid, are dropped: the error is raised by
+        the next call using them rather than by this reload.
+        """
+        index = self._index
+        if index is not None:
+            if old is not None:
+                index.remove(old)
+            if new is not None:
+                index.add(new)
+        search = self._search
+        if search is not None:
+            try:
+                if new is None:
+                    search.remove(path)
+                else:
+                    search.add(new)
+            except Exception:
+                self._search = None
+        orderings = self._orderings
+        for key, entries in orderings.items():
+            try:
+                # Before changing anything, as parsing metadata can fail.
+                old_key = _sort_key(old, key) if old is not None else None
+                new_key = _sort_key(new, key) if new is not None else None
+                if key not in copied:
+                    entries = orderings[key] = list(entries)
+                    copied.add(key)
+                if old is not None:
+                    del entries[bisect.bisect_left(entries, (old_key, path))]
+                if new is not None:
+                    bisect.insort(entries, (new_key, path, new))
+            except Exception:
+                # Eg. keys that can not be compared: leave the error to the
+                # next order_by() call. The copy, if any, is dropped too.
+                del orderings[key]
 
     def _parse(self, string, path):
         """Parse flatpage file with reading meta data and body from it.
 
         :return: initialized :class:`Page` instance.
         """
-        lines = iter(string.split(u'\n'))
-        # Read lines until an empty line is encountered.
-        meta = u'\n'.join(itertools.takewhile(unicode.strip, lines))
-        # The rest is the content. `lines` is an iterator so it continues
-        # where `itertools.takewhile` left it.
-        content = u'\n'.join(lines)
+        timings = self.timings
+        start = timings.enabled and clock()
+        meta, content = _split_page(string)
+        page = self._make_page(path, meta, content)
+        if start:
+            timings.record('parse', clock() - start, path)
+        return page
+
+    def _make_page(self, path, meta_yaml, body):
+        """:return: a :class:`Page` with the current configuration."""
+        html_renderer, template_renderer, template_context = self._renderers()
+        return Page(path, meta_yaml, body, html_renderer, template_renderer,
+                    template_context, self.render_cache(),
+                    self.config('keep_meta_yaml'), self.timings)
 
+    def _renderers(self):
+        """:return: a ``(html_renderer, template_renderer, template_context)``
+        tuple from the configuration, with import strings resolved.
+        """
         html_renderer = self.config('html_renderer')
         template_renderer = self.config('template_renderer')
         template_context = self.config('template_context')
 
         if not callable(html_renderer):
             html_renderer = werkzeug.import_string(html_renderer)
+        if (html_renderer is pygmented_markdown and
+                self._markdown_renderer is not None):
+            html_renderer = self._markdown_renderer
         if not callable(template_renderer):
             template_renderer = werkzeug.import_string(template_renderer)
+        if template_renderer in (render_jinja, render_mako, render_string):
+            template_renderer = self._bind_templates(template_renderer)
+        return html_renderer, template_renderer, template_context
+
+    def _bind_templates(self, renderer):
+        """Return ``renderer`` using the :class:`TemplateCache` of this
+        instance. The same object is returned while the configuration does
+        not change.
+        """
+        directory = self.config('template_cache_dir')
+        if directory:
+            directory = os.path.join(self.app.root_path, directory)
+        templates = self._templates
+        if templates is None or templates.bytecode_directory != directory:
+            templates = self._templates = TemplateCache(
+                bytecode_directory=directory)
+            self._bound_renderers = {}
+        bound = self._bound_renderers.get(renderer)
+        if bound is None:
+            bound = functools.partial(renderer, templates=templates)
+            self._bound_renderers[renderer] = bound
+        return bound
+
+
+class CombinedPages(object):
+    """The pages of several :class:`FlatPages` instances, typically with
+    different roots, seen as one collection. Each instance keeps its own
+    scanner, caches and ``AUTO_RELOAD`` policy: a change in one root does
+    not cause the others to be scanned again.
+
+    ::
+
+        docs = FlatPages(app, name='docs')
+        blog = FlatPages(app, name='blog')
+        pages = CombinedPages(docs, blog)
+        pages.get('blog/hello')
+        pages.query(tags__contains='release').order_by('-date').limit(5)
+
+    In :meth:`get`, paths are prefixed with the name of their instance and a
+    slash. Pages of an instance without a name are not prefixed. Everything
+    else works with :class:`Page` objects and takes the same arguments as in
+    :class:`FlatPages`.
+    """
+
+    def __init__(self, *instances):
+        names = [instance.name for instance in instances]
+        if len(set(names)) != len(names):
+            raise ValueError('FlatPages instances must have distinct names.')
+        #: The combined :class:`FlatPages` instances
+        self.instances = instances
+        self._lock = threading.Lock()
+        #: dict of meta key: (tuple of the orderings of each instance,
+        #: merged ordering)
+        self._orderings = {}
+
+    def __iter__(self):
+        """Iterate on the :class:`Page` objects of all instances."""
+        return itertools.chain(*self.instances)
+
+    def get(self, path, default=None):
+        """Returns the :class:`Page` object at ``path``, prefixed with the
+        name of its instance, or ``default`` if there is no such page.
+        """
+        unnamed = None
+        for instance in self.instances:
+            if instance.name is None:
+                unnamed = instance
+                continue
+            prefix = instance.name + '/'
+            if path.startswith(prefix):
+                page = instance.get(path[len(prefix):])
+                if page is not None:
+                    return page
+        if unnamed is not None:
+            return unnamed.get(path, default)
+        return default
+
+    def get_or_404(self, path):
+        """Like :meth:`get`, but raise Flask's 404 error if there is no
+        such page.
+        """
+        page = self.get(path)
+        if not page:
+            flask.abort(404)
+        return page
+
+    def render_page_response(self, path, render=None):
+        """See :meth:`FlatPages.render_page_response`."""
+        return _page_response(self.get_or_404(path), render)
+
+    def reload(self):
+        """Forget the pages of all instances."""
+        for instance in self.instances:
+            instance.reload()
+
+    def order_by(self, key):
+        """Returns a :class:`PageList` of all pages sorted by the ``key``
+        metadata. See :meth:`FlatPages.order_by`. The cached orderings of
+        each instance are merged, and the result is cached until one of them
+        changes.
+        """
+        return self._ordering(key)._list()
+
+    def _ordering(self, key):
+        """See :meth:`FlatPages._ordering`."""
+        reverse = key.startswith('-')
+        if reverse:
+            key = key[1:]
+        parts = tuple(instance._ordering(key)._entries
+                      for instance in self.instances)
+        with self._lock:
+            cached = self._orderings.get(key)
+            if cached is not None and len(cached[0]) == len(parts) and (
+                    all(a is b for a, b in zip(cached[0], parts))):
+                entries = cached[1]
+            else:
+                # Timsort merges the already sorted runs.
+                entries = sorted(itertools.chain(*parts))
+                self._orderings[key] = parts, entries
+        return _SortedPageView(entries, reverse)
+
+    def filter(self, *args, **kwargs):
+        """Returns pages of all instances matching the specified filters.
+        See :meth:`PageList.filter`.
+        """
+        return self._filter('filter', args, kwargs)
+
+    def filter_any(self, **kwargs):
+        """See :meth:`FlatPages.filter_any`."""
+        return self._filter('filter_any', (), kwargs)
+
+    def filter_all(self, **kwargs):
+        """See :meth:`FlatPages.filter_all`."""
+        return self._filter('filter_all', (), kwargs)
+
+    def _filter(self, method, args, kwargs):
+        result = PageList()
+        for instance in self.instances:
+            result.extend(getattr(instance, method)(*args, **kwargs))
+        return result
+
+    def exclude(self, *args, **kwargs):
+        """A negated filter."""
+        return self.filter(negate=True, *args, **kwargs)
+
+    def query(self, *conditions, **kwargs):
+        """Return a lazy :class:`Query` on the pages of all instances."""
+        return Query(self).filter(*conditions, **kwargs)
+
+    def search(self, query, limit=None):
+        """Full-text search in all instances, see
+        :meth:`FlatPages.search`.
+        """
+        ranked = []
+        for instance in self.instances:
+            pages = instance._pages
+            with instance._lock:
+                ranked.extend(
+                    (score, pages[path]) for path, score in
+                    instance._search_index().search(query, limit))
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        if limit is not None:
+            ranked = ranked[:limit]
+        return PageList(page for score, page in ranked)
+
+    def _meta_index(self):
+        return CombinedIndex([instance._meta_index()
+                              for instance in self.instances])
+
+
+#: :class:`FlatPages` instances with a search index file, written at exit
+#: if they have unsaved changes
+_unsaved_search_indexes = weakref.WeakKeyDictionary()
+
+
+def _save_search_indexes():
+    for pages in _unsaved_search_indexes.keys():
+        # Do not wait for a thread that may never release the lock.
+        if pages._lock.acquire(False):
+            try:
+                pages._save_search_index(force=True)
+            except EnvironmentError:
+                # The index is only a cache, built again on next start.
+                pass
+            finally:
+                pages._lock.release()
+
+atexit.register(_save_search_indexes)
+
+
+def _page_response(page, render):
+    """Implementation of :meth:`FlatPages.render_page_response`."""
+    etag = page.etag
+    last_modified = page.last_modified
+    request = flask.request
+    # is_resource_modified() is false for other methods.
+    if (request.method in ('GET', 'HEAD') and
+            not werkzeug.http.is_resource_modified(
+                request.environ, etag, last_modified=last_modified)):
+        response = flask.current_app.response_class(status=304)
+    else:
+        response = flask.make_response(
+            page.html if render is None else render(page))
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def _parse_filters(kwargs):
+    """Parse the keyword arguments of :meth:`PageList.filter`.
+
+    :return: a list of ``(field, operator, value)`` tuples.
+    """
+    parsed = []
+    for field, value in kwargs.iteritems():
+        try:
+            field_name, condition = field.split('__', 1)
+        except ValueError:
+            field_name = field
+            condition = 'exact'
+        else:
+            # workaround for reserved word
+            if condition == 'in':
+                condition = 'in_'
+        parsed.append((field_name, condition, value))
+    return parsed
 
-        return Page(path, meta, content, html_renderer,
-                    template_renderer, template_context)
+
+def _conjunction(conditions):
+    """Combine :class:`Q` objects with ``&``, or return ``None``."""
+    result = None
+    for condition in conditions:
+        result = condition if result is None else result & condition
+    return result
+
+
+def _all_filters(kwargs):
+    """Return a :class:`Q` matching pages that match all filters."""
+    return _conjunction(Q(**{key: value})
+                        for key, value in kwargs.iteritems()) or Q()
+
+
+def _filter_operator(cond):
+    """Return the function of :mod:`.filters` for an operator name. Errors
+    of the function, eg. comparing a date with a string, are raised as
+    :exc:`ValueError`.
+    """
+    operator = getattr(filters, cond, None)
+    if cond.startswith('_') or not callable(operator):
+        raise ValueError("Unknown operator '%s'" % cond)
+
+    def apply(page, field, value):
+        try:
+            return operator(page, field, value)
+        except (AttributeError, TypeError), error:
+            raise ValueError("Can not apply operator '%s' to field '%s': %s"
+                             % (cond, field, error))
+    return apply
+
+
+def _filter_predicate(index, field, cond, val):
+    """Return a function of a page evaluating one filter, looking up
+    matching pages in ``index`` once if it can answer. The filter is
+    evaluated on pages that were not in the index, eg. pages replaced on
+    reload after a list was derived from it.
+    """
+    operator = _filter_operator(cond)
+    found = None
+    if index is not None:
+        found = index.lookup(field, cond, val)
+    if found is None:
+        return lambda page: operator(page, field, val)
+    matched, candidates, covered = found
+    matched = set(matched)
+    for page in candidates:
+        if operator(page, field, val):
+            matched.add(page)
+
+    def predicate(page):
+        if page in matched:
+            return True
+        if covered(page):
+            return False
+        return operator(page, field, val)
+    return predicate
+
+
+def _sort_key(page, key):
+    """Return the value of the ``key`` metadata for sorting ``page``."""
+    return page[key] if key in page.meta else PageList.MINDATE
+
+
+def _reuse_meta(old, new):
+    """Give ``new`` the parsed metadata of ``old`` if they have the same
+    header, typically when only the body of a page file was modified.
+    """
+    meta = old._meta
+    if (meta is not None and new._meta is None and
+            old._meta_yaml is not None and old._meta_yaml == new._meta_yaml):
+        new._meta = meta
+        if not new._config.keep_meta_yaml:
+            new._drop_meta_yaml()
+
+
+#: Files modified less than this many seconds before being checked have no
+#: fingerprint: a later edit may not change their modification time, on
+#: file systems where it is coarse.
+_racy_seconds = 2
+
+
+def _fingerprint(stat):
+    """Return a tuple identifying a version of a file from its ``stat``
+    result, or ``None`` if it was modified too recently to be trusted.
+    """
+    if time.time() - stat.st_mtime < _racy_seconds:
+        return None
+    return stat.st_mtime, stat.st_size, stat.st_ino
+
+
+def _is_ascii_compatible(encoding):
+    """Whether line breaks and spaces can be found in ``encoding`` without
+    decoding.
+    """
+    return u'\n \t\r'.encode(encoding) == '\n \t\r'
+
+
+def _read_body(filename, offset, mtime, encoding):
+    """Read the body of a page file, starting at byte ``offset`` unless the
+    file was modified since its header was read at ``mtime``.
+    """
+    with open(filename, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_mtime != mtime:
+            return _split_page(fd.read().decode(encoding))[1]
+        fd.seek(offset)
+        return fd.read().decode(encoding)
+
+
+def _split_page(string):
+    """Split the content of a page file.
+
+    :return: a ``(meta, body)`` tuple of unicode strings.
+    """
+    lines = iter(string.split(u'\n'))
+    # Read lines until an empty line is encountered.
+    meta = u'\n'.join(itertools.takewhile(unicode.strip, lines))
+    # The rest is the content. `lines` is an iterator so it continues
+    # where `itertools.takewhile` left it.
+    content = u'\n'.join(lines)
+    return meta, content
+
+
+def _cpu_count():
+    """Return the number of CPUs, or 1 without :mod:`multiprocessing`."""
+    if multiprocessing is None:
+        return 1
+    return multiprocessing.cpu_count()
+
+
+def _make_pool(workers, executor):
+    """Return a :mod:`multiprocessing` pool of processes or threads."""
+    if executor == 'process':
+        return multiprocessing.Pool(workers)
+    elif executor == 'thread':
+        return multiprocessing.pool.ThreadPool(workers)
+    raise ValueError("Unknown executor '%s'" % executor)
+
+
+def _map_jobs(jobs, workers, executor):
+    """Return the results of :func:`_prerender_file` for ``jobs``, computed
+    in a pool of ``workers`` processes or threads. Without
+    :mod:`multiprocessing` (Python 2.5), they are computed in this thread.
+    """
+    if multiprocessing is None:
+        if executor not in ('process', 'thread'):
+            raise ValueError("Unknown executor '%s'" % executor)
+        return map(_prerender_file, jobs)
+    pool = _make_pool(workers, executor)
+    try:
+        chunksize = max(1, len(jobs) // (workers * 4))
+        return pool.map(_prerender_file, jobs, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _render_job(page):
+    """Return a job for :func:`_prerender_file` rendering ``page`` in
+    another process.
+    """
+    config = page._config
+    render_cache = config.render_cache
+    if render_cache is not None:
+        render_cache = render_cache.filename, render_cache.max_size
+    # Only the HTML is used: do not parse the metadata again.
+    return (page.path, None, (u'', page.body), None,
+            config.html_renderer, config.template_renderer, config.context,
+            render_cache)
+
+
+def _store_rendered(page, result):
+    """Keep the HTML and intro rendered by :func:`_prerender_file` in
+    ``page``, unless it already has them.
+    """
+    html, intro = result[-2:]
+    if page._html is None:
+        page._html = html
+    if page._intro is None:
+        page._intro = intro
+
+
+#: dict of (filename, max_size): :class:`~.cache.RenderCache` of workers
+_worker_render_caches = {}
+
+
+def _worker_render_cache(settings):
+    """Return the :class:`~.cache.RenderCache` for ``(filename, max_size)``
+    in a worker. It is kept for later jobs, so that each worker opens one
+    connection to the database.
+    """
+    cache = _worker_render_caches.get(settings)
+    if cache is None:
+        cache = _worker_render_caches[settings] = RenderCache(*settings)
+    return cache
+
+
+def _prerender_file(job):
+    """Read, parse and render a page file, in a worker of
+    :meth:`FlatPages.prerender`. The file is not read if its source is
+    passed in ``job``.
+
+    :return: a ``(path, filename, mtime, digest, meta_yaml, body, meta,
+             html, intro)`` tuple, where ``mtime`` and ``digest``, the SHA-1
+             digest of the file, are ``None`` if it was not read.
+    """
+    (path, filename, source, encoding, html_renderer, template_renderer,
+     template_context, render_cache) = job
+    if render_cache is not None:
+        render_cache = _worker_render_cache(render_cache)
+    mtime = digest = None
+    if source is None:
+        mtime = os.path.getmtime(filename)
+        with open(filename) as fd:
+            content = fd.read()
+        digest = hashlib.sha1(content).digest()
+        source = _split_page(content.decode(encoding))
+    meta_yaml, body = source
+    page = Page(path, meta_yaml, body, html_renderer, template_renderer,
+                template_context, render_cache)
+    return (path, filename, mtime, digest, meta_yaml, body,
+            page.meta, page.html, page.intro)
@@ -0,0 +1,155 @@
+# coding: utf8
+"""
+    flask_flatpages.bundle
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    A single file holding the body, parsed metadata and rendered HTML of
+    every page, built at deploy time with :meth:`.FlatPages.build_bundle`
+    and used instead of the pages root when ``FLATPAGES_BUNDLE`` is set.
+
+    The file starts with :data:`MAGIC` and the offset of the index, followed
+    by one record per page and the index: a marshalled dict of path:
+    ``(offset, size, mtime, etag)``. It is mapped in memory, so only the
+    index is read when opening it and records are read when pages are
+    accessed. Processes mapping the same file share its memory.
+
+    A record holds the lengths of the UTF-8 encoded body, HTML and intro of
+    the page, these three strings, then the pickled metadata. Each of them
+    can be read without the others.
+
+    Metadata are pickles: only use bundles that you built yourself.
+
+    Build a bundle from the command line with::
+
+        $ python -m flask_flatpages.bundle myapp:pages [FILENAME]
+
+    where ``myapp:pages`` is the import name of a :class:`.FlatPages`
+    instance, or with the ``flask flatpages-bundle`` command.
+
+    :copyright: (c) 2010 by Simon Sapin.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import cPickle as pickle
+import marshal
+import mmap
+import os
+import struct
+import sys
+
+
+#: Identifies bundle files and their format version
+MAGIC = 'Flask-FlatPages bundle 3\n'
+
+_header = struct.Struct('<Q')
+_lengths = struct.Struct('<III')
+
+#: Text fields of records, for :meth:`Bundle.read`
+BODY, HTML, INTRO = range(3)
+
+
+class Bundle(object):
+    """A bundle file opened for reading."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fd:
+            stat = os.fstat(fd.fileno())
+            #: ``(mtime, size, inode)`` of the file when it was opened
+            self.stat = stat.st_mtime, stat.st_size, stat.st_ino
+            if stat.st_size < len(MAGIC) + _header.size:
+                raise ValueError('Not a page bundle: %r' % filename)
+            self._data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._data[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a page bundle: %r' % filename)
+        index_offset, = _header.unpack_from(self._data, len(MAGIC))
+        #: dict of page path: ``(offset, size, mtime, etag)``, where offset
+        #: and size locate the record of the page
+        self.entries = marshal.loads(self._data[index_offset:])
+
+    def is_current(self):
+        """Whether the file was not replaced since it was opened."""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return False
+        return (stat.st_mtime, stat.st_size, stat.st_ino) == self.stat
+
+    def read(self, offset, field):
+        """Decode the :data:`BODY`, :data:`HTML` or :data:`INTRO` of the
+        record at ``offset``.
+        """
+        lengths = _lengths.unpack_from(self._data, offset)
+        start = offset + _lengths.size + sum(lengths[:field])
+        return self._data[start:start + lengths[field]].decode('utf8')
+
+    def read_meta(self, offset, size):
+        """Unpickle the metadata of the record at ``offset``."""
+        start = (offset + _lengths.size +
+                 sum(_lengths.unpack_from(self._data, offset)))
+        return pickle.loads(self._data[start:offset + size])
+
+
+def write_bundle(filename, pages):
+    """Write the given :class:`.Page` objects to a new bundle file. Their
+    metadata is parsed and their HTML rendered if it is not already.
+
+    The file is replaced atomically, so that processes still using the
+    previous version are not disturbed.
+
+    :return: the number of pages written.
+    """
+    temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    entries = {}
+    try:
+        with open(temp_filename, 'wb') as fd:
+            fd.write(MAGIC)
+            fd.write(_header.pack(0))
+            for page in pages:
+                texts = [_encode(text)
+                         for text in (page.body, page.html, page.intro)]
+                record = (_lengths.pack(*map(len, texts)) + ''.join(texts) +
+                          pickle.dumps(page.meta, pickle.HIGHEST_PROTOCOL))
+                entries[page.path] = (fd.tell(), len(record), page._mtime,
+                                      page.etag)
+                fd.write(record)
+            index_offset = fd.tell()
+            fd.write(marshal.dumps(entries))
+            fd.seek(len(MAGIC))
+            fd.write(_header.pack(index_offset))
+        if os.name == 'nt' and os.path.exists(filename):
+            # No atomic replace on Windows.
+            os.remove(filename)
+        os.rename(temp_filename, filename)
+    except:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    return len(entries)
+
+
+def _encode(text):
+    """Encode a unicode string to UTF-8. Byte strings, eg. from renderers
+    returning them, are assumed to be UTF-8 already.
+    """
+    if isinstance(text, unicode):
+        return text.encode('utf8')
+    return text
+
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        sys.exit('Usage: python -m flask_flatpages.bundle '
+                 'IMPORT_NAME [FILENAME]')
+    import werkzeug
+    pages = werkzeug.import_string(argv[1])
+    filename = argv[2] if len(argv) == 3 else None
+    with pages.app.test_request_context():
+        count = pages.build_bundle(filename)
+    print 'Wrote %d pages.' % count
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,256 @@
+# coding: utf8
+"""
+    flask_flatpages.cache
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Persistent cache of rendered pages, stored in a SQLite database on the
+    local disk so that it survives restarts and is shared by every worker
+    process of an application.
+
+    :copyright: (c) 2010 by Simon Sapin.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import contextlib
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import types
+
+
+class RenderCache(object):
+    """A size-bounded key/value store of rendered HTML.
+
+    Keys are hashes of everything that affects a rendering: the source text
+    and the renderers configuration (see :meth:`key`). When the total size
+    of stored values goes over ``max_size`` bytes, least recently used
+    entries are evicted.
+    """
+
+    #: Access times are not written back more often than this (in seconds),
+    #: to keep reads from taking the database write lock.
+    touch_interval = 60
+
+    def __init__(self, filename, max_size=64 * 1024 * 1024):
+        self.filename = filename
+        self.max_size = max_size
+        self._local = threading.local()
+
+    def _connection(self):
+        """Return a connection for the current thread and process.
+
+        SQLite connections can not be shared between threads, nor survive a
+        ``fork()``.
+        """
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, 'pid', None) != pid:
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            connection = sqlite3.connect(self.filename, timeout=30)
+            connection.text_factory = unicode
+            with _transaction(connection):
+                _create_schema(connection)
+            local.connection = connection
+            local.pid = pid
+        return local.connection
+
+    @staticmethod
+    def key(*parts):
+        """Return a cache key for the given unicode or byte strings."""
+        digest = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf8')
+            digest.update(part)
+            digest.update('\0')
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the value stored for ``key``, or ``None``."""
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT value, atime FROM renders WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, atime = row
+        now = int(time.time())
+        if now - atime > self.touch_interval:
+            with _transaction(connection):
+                connection.execute(
+                    'UPDATE renders SET atime = ? WHERE key = ?', (now, key))
+        return value
+
+    def set(self, key, value):
+        """Store ``value`` under ``key`` and evict old entries if needed."""
+        connection = self._connection()
+        size = len(value.encode('utf8') if isinstance(value, unicode)
+                   else value)
+        row = key, value, size, int(time.time())
+        with _transaction(connection):
+            # The UPDATE takes the write lock: no other process can insert
+            # the key before the INSERT.
+            if not connection.execute(
+                    'UPDATE renders SET value = ?, size = ?, atime = ? '
+                    'WHERE key = ?', row[1:] + row[:1]).rowcount:
+                connection.execute(
+                    'INSERT INTO renders VALUES (?, ?, ?, ?)', row)
+            self._evict(connection)
+
+    def clear(self):
+        """Remove all entries."""
+        connection = self._connection()
+        with _transaction(connection):
+            connection.execute('DELETE FROM renders')
+
+    def _evict(self, connection):
+        """Delete least recently used entries until the total size is
+        below 90% of ``max_size``.
+        """
+        total = connection.execute(
+            "SELECT value FROM render_stats WHERE name = 'size'"
+        ).fetchone()[0]
+        if total <= self.max_size:
+            return
+        target = total - self.max_size * 0.9
+        freed = 0
+        victims = []
+        for key, size in connection.execute(
+                'SELECT key, size FROM renders ORDER BY atime, rowid'):
+            victims.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        connection.executemany('DELETE FROM renders WHERE key = ?', victims)
+
+
+def _create_schema(connection):
+    """Create the tables of a new cache, and add the running total of the
+    size of values to caches created by older versions.
+
+    Triggers keep the total up to date in the transaction changing the
+    entries, so that :meth:`RenderCache.set` does not add up the sizes of
+    all entries.
+    """
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS renders ('
+        'key TEXT PRIMARY KEY, value TEXT, size INTEGER, atime INTEGER)')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS renders_atime ON renders (atime)')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS render_stats ('
+        'name TEXT PRIMARY KEY, value INTEGER)')
+    for event, change in [('INSERT', 'NEW.size'),
+                          ('DELETE', '-OLD.size'),
+                          ('UPDATE OF size', 'NEW.size - OLD.size')]:
+        connection.execute(
+            'CREATE TRIGGER IF NOT EXISTS renders_%s '
+            'AFTER %s ON renders BEGIN '
+            "UPDATE render_stats SET value = value + %s WHERE name = 'size'; "
+            'END' % (event.split()[0].lower(), event, change))
+    # After the triggers: entries added in between are in the sum.
+    connection.execute(
+        "INSERT OR IGNORE INTO render_stats SELECT 'size', "
+        "COALESCE(SUM(size), 0) FROM renders")
+
+
+@contextlib.contextmanager
+def _transaction(connection):
+    """Commit on success, roll back on errors. SQLite connections are only
+    context managers since Python 2.6.
+    """
+    try:
+        yield connection
+    except:
+        connection.rollback()
+        raise
+    connection.commit()
+
+
+def renderer_signature(html_renderer, template_renderer, context):
+    """Return a unicode string describing a renderers configuration, to be
+    included in :meth:`RenderCache.key`.
+
+    The description is the same in every process: callables are named by
+    their module and name rather than by their address. It includes the
+    versions of Markdown and Pygments, so that upgrading them invalidates
+    cached renderings.
+    """
+    extensions = getattr(html_renderer, 'markdown_extensions', None)
+    if extensions is not None:
+        extensions = tuple(extensions)
+    parts = [_describe(html_renderer), _describe(template_renderer),
+             _describe(extensions), _describe(context), _library_versions()]
+    return u'\n'.join(part.decode('utf8', 'replace')
+                      if isinstance(part, str) else part for part in parts)
+
+
+def _describe(value):
+    """Return a string describing ``value`` without object addresses."""
+    if isinstance(value, functools.partial):
+        # Renderers bound to a FlatPages instance, among others
+        arguments = [_describe(value.func)]
+        arguments.extend(_describe(arg) for arg in value.args or ())
+        arguments.extend('%s=%s' % (name, _describe(arg)) for name, arg
+                         in sorted((value.keywords or {}).iteritems()))
+        return 'functools.partial(%s)' % ', '.join(arguments)
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(sorted(
+            '%s: %s' % (_describe(key), _describe(item))
+            for key, item in value.iteritems()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [_describe(item) for item in value]
+        if isinstance(value, (set, frozenset)):
+            items.sort()
+        return '%s(%s)' % (type(value).__name__, ', '.join(items))
+    if value is None or isinstance(value, (basestring, int, long, float)):
+        return repr(value)
+    bound_to = getattr(value, '__self__', None)
+    if (isinstance(value, (types.MethodType, types.BuiltinMethodType)) and
+            bound_to is not None):
+        return '%s.%s' % (_describe(bound_to), value.__name__)
+    name = getattr(value, '__name__', None)
+    if isinstance(name, basestring) and (
+            callable(value) or isinstance(value, types.ModuleType)):
+        # Functions, classes, unbound methods and modules
+        owner = getattr(value, '__objclass__', None) or getattr(
+            value, 'im_class', None)
+        if owner is not None:
+            return '%s.%s' % (_describe(owner), name)
+        return '%s.%s' % (getattr(value, '__module__', None), name)
+    if type(value).__repr__ is object.__repr__:
+        # The default repr() is the type and address of the object.
+        return '<%s>' % _describe(type(value))
+    return repr(value)
+
+
+#: Cached result of :func:`_library_versions`
+_versions = None
+
+
+def _library_versions():
+    """Return the versions of the libraries used by the default renderers.
+    """
+    global _versions
+    if _versions is None:
+        versions = []
+        for name in ('markdown', 'pygments'):
+            try:
+                module = __import__(name)
+            except ImportError:
+                version = None
+            else:
+                # markdown.__version__ is a module in Markdown 2.x
+                version = getattr(module, 'version', None)
+                if not isinstance(version, basestring):
+                    version = getattr(module, '__version__', None)
+            versions.append('%s %s' % (name, version))
+        _versions = ', '.join(versions)
+    return _versions
@@ -0,0 +1,203 @@
+# coding: utf8
+"""
+    flask_flatpages.executor
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Background workers for the ``*_async`` methods of :class:`.FlatPages`,
+    so that event-driven servers do not wait for file reads or rendering,
+    and coalescing of concurrent calls doing the same work.
+
+    :copyright: (c) 2010 by Simon Sapin.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import sys
+import threading
+
+try:
+    import multiprocessing
+    import multiprocessing.pool
+except ImportError:
+    # Python 2.5
+    multiprocessing = None
+
+
+class Executor(object):
+    """Run functions in a pool of threads. Calls submitted with the same key
+    while one is running share its result instead of running again.
+
+    :param workers: Number of threads, defaults to the number of CPUs.
+    :param kind: ``'thread'`` to run CPU-bound work passed to :meth:`call`
+                 in the calling thread, or ``'process'`` to run it in a
+                 pool of processes, away from the GIL.
+
+    Needs :mod:`multiprocessing`, new in Python 2.6.
+    """
+
+    def __init__(self, workers=None, kind='thread'):
+        if kind not in ('thread', 'process'):
+            raise ValueError("Unknown executor '%s'" % kind)
+        if multiprocessing is None:
+            raise RuntimeError('Background calls need the multiprocessing '
+                               'module, new in Python 2.6.')
+        self.workers = workers or multiprocessing.cpu_count()
+        self.kind = kind
+        self._threads = None
+        self._processes = None
+        self._lock = threading.Lock()
+        #: dict of key: (:class:`~multiprocessing.pool.AsyncResult`, list
+        #: of callbacks) of the calls currently running
+        self._running = {}
+
+    def submit(self, key, function, args=(), callback=None,
+               error_callback=None):
+        """Call ``function(*args)`` in a thread.
+
+        :param key: Hashable identifying the call for coalescing, or
+                    ``None`` to always make a new call.
+        :param callback: Called with the result when the call succeeds.
+        :param error_callback: Called with the exception when the call
+                               fails.
+        :return: a :class:`~multiprocessing.pool.AsyncResult`.
+
+        Callbacks are called in the worker thread, before the result is
+        ready. They should return quickly, eg. by handing the result over to
+        an event loop.
+        """
+        callbacks = callback, error_callback
+        with self._lock:
+            if key is not None:
+                running = self._running.get(key)
+                if running is not None:
+                    result, waiting = running
+                    waiting.append(callbacks)
+                    return result
+            if self._threads is None:
+                self._threads = multiprocessing.pool.ThreadPool(self.workers)
+            waiting = [callbacks]
+            result = self._threads.apply_async(
+                self._run, (key, function, args, waiting))
+            if key is not None:
+                # The worker can not remove it before this: it takes the lock.
+                self._running[key] = result, waiting
+            return result
+
+    def _run(self, key, function, args, waiting):
+        try:
+            value = function(*args)
+        except Exception:
+            error = sys.exc_info()
+            self._finish(key)
+            for callback, error_callback in waiting:
+                if error_callback is not None:
+                    error_callback(error[1])
+            raise error[0], error[1], error[2]
+        self._finish(key)
+        for callback, error_callback in waiting:
+            if callback is not None:
+                callback(value)
+        return value
+
+    def _finish(self, key):
+        """Stop coalescing calls with ``key``. Callbacks can not be added
+        to the call anymore after this.
+        """
+        if key is not None:
+            with self._lock:
+                del self._running[key]
+
+    def call(self, function, *args):
+        """Call ``function(*args)`` in a process if :attr:`kind` is
+        ``'process'``, or directly. Meant to be used from submitted
+        functions, for CPU-bound work. ``function`` and its arguments must
+        be picklable with processes.
+        """
+        if self.kind == 'thread':
+            return function(*args)
+        return self._process_pool().apply(function, args)
+
+    def map(self, function, items):
+        """Like :meth:`call`, for each of ``items``.
+
+        :return: the list of results.
+        """
+        if self.kind == 'thread':
+            return map(function, items)
+        chunksize = max(1, len(items) // (self.workers * 4))
+        return self._process_pool().map(function, items, chunksize)
+
+    def _process_pool(self):
+        with self._lock:
+            if self._processes is None:
+                self._processes = multiprocessing.Pool(self.workers)
+            return self._processes
+
+    def close(self):
+        """Wait for running calls and stop the threads and processes."""
+        with self._lock:
+            pools = self._threads, self._processes
+            self._threads = self._processes = None
+        for pool in pools:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+
+class SingleFlight(object):
+    """Run a function once for concurrent calls with the same key: the
+    first caller runs it while the others wait for its result.
+
+    No lock is held while the function runs, so it can itself use a
+    :class:`SingleFlight` with other keys.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        #: dict of key: :class:`_Flight` of the calls currently running
+        self._flights = {}
+
+    def run(self, key, function, *args):
+        """Return ``function(*args)``, or the result of the call running for
+        ``key`` in another thread. Its exceptions are raised in all
+        threads waiting for it.
+        """
+        thread = threading.currentThread()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight(thread)
+                leader = True
+            elif flight.thread is thread:
+                # A recursive call would wait for itself forever.
+                leader = None
+            else:
+                leader = False
+        if leader is None:
+            return function(*args)
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return flight.result
+        try:
+            flight.result = function(*args)
+        except:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+
+class _Flight(object):
+    __slots__ = ('thread', 'done', 'result', 'error')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
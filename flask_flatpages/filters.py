@@ -49,3 +49,19 @@ def istartswith(page, field, value):
     except AttributeError:
         pass
     return res
+
+def gt(page, field, value):
+    _field = getattr(page, field)
+    return _field is not None and _field > value
+
+def gte(page, field, value):
+    _field = getattr(page, field)
+    return _field is not None and _field >= value
+
+def lt(page, field, value):
+    _field = getattr(page, field)
+    return _field is not None and _field < value
+
+def lte(page, field, value):
+    _field = getattr(page, field)
+    return _field is not None and _field <= value
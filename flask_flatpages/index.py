@@ -0,0 +1,358 @@
+# coding: utf8
+"""
+    flask_flatpages.index
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Secondary indexes over page metadata, used to answer
+    :meth:`~flask_flatpages.PageList.filter` queries without evaluating every
+    operator of :mod:`flask_flatpages.filters` on every page.
+
+    Lookups return ``None`` whenever the answer could differ from the
+    operator functions, in which case the caller falls back to scanning.
+
+    :copyright: (c) 2010 by Simon Sapin.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import bisect
+import datetime
+import threading
+
+
+_CONTAINERS = (list, tuple, set, frozenset, dict)
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def _family(value):
+    """Return a key for types that can be ordered together, or ``None``."""
+    if isinstance(value, bool) or isinstance(value, (int, long, float)):
+        return 'number'
+    if isinstance(value, basestring):
+        return 'string'
+    if isinstance(value, (datetime.date, datetime.time)):
+        # datetime is a subclass of date but they can not be compared.
+        return type(value)
+    return None
+
+
+class FieldIndex(object):
+    """Indexes of the values of one metadata field."""
+
+    def __init__(self, field):
+        self.field = field
+        #: dict of page: (value, sequence number)
+        self.values = {}
+        #: Hash index: dict of hashable value: set of pages
+        self.hashed = {}
+        #: set of pages with an unhashable value
+        self.unhashable = set()
+        #: Inverted index: dict of element: set of pages, for containers
+        #: with hashable elements
+        self.elements = {}
+        #: set of pages where ``contains`` can only be answered by scanning
+        self.contains_scan = set()
+        #: dict of ordering family: number of pages
+        self.families = {}
+        #: Sorted indexes: dict of ordering family: sorted list of
+        #: (value, sequence number, page), built on first use
+        self.sorted = {}
+
+    def add(self, page, seq):
+        value = page.meta.get(self.field)
+        self.values[page] = value, seq
+        if _hashable(value):
+            self.hashed.setdefault(value, set()).add(page)
+        else:
+            self.unhashable.add(page)
+        if value:
+            elements = self._elements(value)
+            if elements is None:
+                self.contains_scan.add(page)
+            else:
+                for element in elements:
+                    self.elements.setdefault(element, set()).add(page)
+        if value is not None:
+            family = _family(value)
+            self.families[family] = self.families.get(family, 0) + 1
+            entries = self.sorted.get(family)
+            if entries is not None:
+                bisect.insort(entries, (value, seq, page))
+
+    def remove(self, page):
+        value, seq = self.values.pop(page)
+        if _hashable(value):
+            self._discard(self.hashed, value, page)
+        else:
+            self.unhashable.discard(page)
+        if value:
+            elements = self._elements(value)
+            if elements is None:
+                self.contains_scan.discard(page)
+            else:
+                for element in elements:
+                    self._discard(self.elements, element, page)
+        if value is not None:
+            family = _family(value)
+            self.families[family] -= 1
+            if not self.families[family]:
+                del self.families[family]
+            entries = self.sorted.get(family)
+            if entries is not None:
+                del entries[bisect.bisect_left(entries, (value, seq))]
+
+    @staticmethod
+    def _discard(index, key, page):
+        pages = index[key]
+        pages.discard(page)
+        if not pages:
+            del index[key]
+
+    @staticmethod
+    def _elements(value):
+        """Return the elements of ``value`` as seen by the ``in`` operator
+        if they can all be hashed, or ``None``.
+        """
+        if not isinstance(value, _CONTAINERS):
+            return None
+        elements = set()
+        for element in value:
+            if not _hashable(element):
+                return None
+            elements.add(element)
+        return elements
+
+    def _sorted(self, family):
+        entries = self.sorted.get(family)
+        if entries is None:
+            entries = sorted(
+                (value, seq, page)
+                for page, (value, seq) in self.values.iteritems()
+                if value is not None and _family(value) == family)
+            self.sorted[family] = entries
+        return entries
+
+    def lookup(self, condition, value):
+        """Return a ``(matched, candidates)`` tuple where ``matched`` is a
+        set of pages known to match and ``candidates`` are pages that the
+        operator function has to be evaluated on, or ``None`` if the index
+        can not answer.
+        """
+        method = getattr(self, '_lookup_' + condition, None)
+        if method is None:
+            return None
+        return method(value)
+
+    def _lookup_exact(self, value):
+        if _hashable(value):
+            matched = set(self.hashed.get(value, ()))
+        else:
+            matched = set()
+        # Unhashable values like lists can only be compared.
+        return matched, list(self.unhashable)
+
+    def _lookup_in_(self, value):
+        if isinstance(value, basestring):
+            # Substring semantics
+            return None
+        matched = set()
+        try:
+            items = iter(value or [])
+        except TypeError:
+            return None
+        for item in items:
+            if not _hashable(item):
+                return None
+            matched.update(self.hashed.get(item, ()))
+        return matched, list(self.unhashable)
+
+    def _lookup_exists(self, value):
+        missing = self.hashed.get(None, set())
+        if value == True:
+            matched = set(page for page in self.values if page not in missing)
+        elif value == False:
+            matched = set(missing)
+        else:
+            matched = set()
+        return matched, ()
+
+    def _lookup_contains(self, value):
+        if not _hashable(value):
+            return None
+        # Strings (substring semantics) and other values are evaluated.
+        return set(self.elements.get(value, ())), list(self.contains_scan)
+
+    def _lookup_startswith(self, value):
+        if not isinstance(value, basestring):
+            return None
+        # Only strings can match, other values are not a concern.
+        entries = self._sorted('string')
+        matched = set()
+        try:
+            start = bisect.bisect_left(entries, (value,))
+        except UnicodeError:
+            return None
+        for position in xrange(start, len(entries)):
+            entry = entries[position]
+            if not entry[0].startswith(value):
+                break
+            matched.add(entry[2])
+        return matched, ()
+
+    def _lookup_range(self, value, condition):
+        family = _family(value)
+        if family is None or list(self.families) not in ([], [family]):
+            # Comparisons between different types: let them be evaluated.
+            return None
+        entries = self._sorted(family)
+        key = (value,)
+        if condition in ('gt', 'lte'):
+            # Entries equal to value sort after (value,): skip them too.
+            position = bisect.bisect_left(entries, key)
+            while position < len(entries) and entries[position][0] == value:
+                position += 1
+        else:
+            position = bisect.bisect_left(entries, key)
+        if condition in ('gt', 'gte'):
+            selected = entries[position:]
+        else:
+            selected = entries[:position]
+        return set(entry[2] for entry in selected), ()
+
+    def _lookup_gt(self, value):
+        return self._lookup_range(value, 'gt')
+
+    def _lookup_gte(self, value):
+        return self._lookup_range(value, 'gte')
+
+    def _lookup_lt(self, value):
+        return self._lookup_range(value, 'lt')
+
+    def _lookup_lte(self, value):
+        return self._lookup_range(value, 'lte')
+
+
+class MetaIndex(object):
+    """Indexes over the metadata of a set of pages, built one field at a
+    time on first use and kept up to date with :meth:`add` and
+    :meth:`remove`.
+
+    Lookups can run while another thread updates the index: both take a
+    lock, and lookups return new collections.
+    """
+
+    def __init__(self, pages=()):
+        self._lock = threading.Lock()
+        #: dict of page: sequence number
+        self.pages = {}
+        #: dict of field name: :class:`FieldIndex`, or ``None`` for
+        #: fields that are not metadata
+        self.fields = {}
+        self._counter = 0
+        for page in pages:
+            self.add(page)
+
+    def add(self, page):
+        with self._lock:
+            seq = self._counter
+            self._counter += 1
+            self.pages[page] = seq
+            for field, index in self.fields.items():
+                if index is not None:
+                    try:
+                        index.add(page, seq)
+                    except Exception:
+                        # Eg. invalid metadata: forget the field, the error
+                        # is raised when it is indexed again on lookup.
+                        del self.fields[field]
+
+    def remove(self, page):
+        with self._lock:
+            if self.pages.pop(page, None) is None:
+                return
+            for index in self.fields.itervalues():
+                if index is not None:
+                    index.remove(page)
+
+    def _field(self, field):
+        try:
+            return self.fields[field]
+        except KeyError:
+            pass
+        index = None
+        if self.pages:
+            sample = iter(self.pages).next()
+            # Real attributes like ``body`` are not metadata.
+            if not (hasattr(type(sample), field) or
+                    field in getattr(sample, '__dict__', ())):
+                index = FieldIndex(field)
+                for page, seq in self.pages.iteritems():
+                    index.add(page, seq)
+        self.fields[field] = index
+        return index
+
+    def lookup(self, field, condition, value):
+        """Look up pages where ``field`` matches ``condition`` with
+        ``value``.
+
+        :return: ``None`` if the index can not answer, or a ``(matched,
+                 candidates, covered)`` tuple as in :meth:`FieldIndex.lookup`
+                 where ``covered`` is a function of a page returning whether
+                 it was in the index at the time of the lookup. The operator
+                 function has to be evaluated on pages that were not, eg.
+                 pages added or replaced since.
+        """
+        with self._lock:
+            index = self._field(field)
+            if index is None:
+                return None
+            found = index.lookup(condition, value)
+            if found is None:
+                return None
+            return found + (self._covered(self._counter),)
+
+    def _covered(self, counter):
+        pages = self.pages
+
+        def covered(page):
+            # Pages added later have a higher sequence number.
+            seq = pages.get(page)
+            return seq is not None and seq < counter
+        return covered
+
+
+class CombinedIndex(object):
+    """Lookups in several :class:`MetaIndex` objects of distinct pages, as
+    if they were one.
+    """
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def lookup(self, field, condition, value):
+        """See :meth:`MetaIndex.lookup`."""
+        matched = set()
+        candidates = []
+        covered = []
+        for index in self.indexes:
+            found = index.lookup(field, condition, value)
+            if found is None:
+                return None
+            matched.update(found[0])
+            candidates.extend(found[1])
+            covered.append(found[2])
+
+        def covered_by_any(page):
+            for function in covered:
+                if function(page):
+                    return True
+            return False
+        return matched, candidates, covered_by_any
@@ -0,0 +1,162 @@
+# coding: utf8
+"""
+    flask_flatpages.scanner
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Incremental discovery of page files in a directory tree.
+
+    :copyright: (c) 2010 by Simon Sapin.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class Scanner(object):
+    """Find files ending with ``extension`` under ``root``, remembering the
+    modification time of each directory so that unchanged directories are
+    not listed again on the next :meth:`scan`.
+
+    Adding, removing or renaming an entry changes the modification time of
+    its parent directory, but editing a file in place does not: detecting
+    modified files is left to the caller, for example by comparing file
+    modification times.
+    """
+
+    #: Directories modified less than this many seconds before they were
+    #: listed are listed again on the next scan, as more changes may have
+    #: happened within the timestamp resolution of the filesystem.
+    racy_delay = 2
+
+    def __init__(self, root, extension):
+        self.root = root
+        self.extension = extension
+        #: dict of filename: page path, for all known page files
+        self.files = {}
+        #: dict of directory: (mtime, time listed, subdirectory names,
+        #: dict of filename: page path, page path prefix)
+        self._directories = {}
+
+    def scan(self):
+        """Update :attr:`files`.
+
+        :return: a ``(added, removed)`` tuple of dicts of filename: path.
+        """
+        added = {}
+        removed = {}
+        self._scan(self.root, (), added, removed)
+        for filename in removed:
+            del self.files[filename]
+        self.files.update(added)
+        return added, removed
+
+    def update(self, directories):
+        """List the given directories again regardless of their modification
+        time, and scan any new subdirectory in them. Unknown directories are
+        ignored: they are found when their parent is listed.
+
+        :return: a ``(added, removed)`` tuple of dicts of filename: path.
+        """
+        added = {}
+        removed = {}
+        # Parents first, so that their new subdirectories are complete.
+        for directory in sorted(directories, key=len):
+            state = self._directories.get(directory)
+            if state is None:
+                continue
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                # Removed, the parent is listed again or will be.
+                continue
+            self._relist(directory, mtime, state[4], state, added, removed,
+                         recursive=False)
+        for filename in removed:
+            self.files.pop(filename, None)
+        self.files.update(added)
+        return added, removed
+
+    def _scan(self, directory, path_prefix, added, removed):
+        mtime = os.stat(directory).st_mtime
+        state = self._directories.get(directory)
+        if (state is not None and state[0] == mtime and
+                mtime < state[1] - self.racy_delay):
+            for name in state[2]:
+                self._scan(os.path.join(directory, name),
+                           path_prefix + (name,), added, removed)
+        else:
+            self._relist(directory, mtime, path_prefix, state, added,
+                         removed, recursive=True)
+
+    def _relist(self, directory, mtime, path_prefix, state, added, removed,
+                recursive):
+        """List ``directory`` and record the differences with its previous
+        ``state``. Subdirectories are scanned if ``recursive`` is true or if
+        they are new.
+        """
+        listed_at = time.time()
+        subdirectories, files = self._list(directory, path_prefix)
+        if state is None:
+            old_subdirectories, old_files = (), {}
+        else:
+            old_subdirectories, old_files = state[2], state[3]
+        for filename, path in files.iteritems():
+            if filename not in old_files:
+                added[filename] = path
+        for filename, path in old_files.iteritems():
+            if filename not in files:
+                removed[filename] = path
+        for name in old_subdirectories:
+            if name not in subdirectories:
+                self._forget(os.path.join(directory, name), removed)
+        self._directories[directory] = (
+            mtime, listed_at, subdirectories, files, path_prefix)
+
+        for name in subdirectories:
+            if recursive or name not in old_subdirectories:
+                self._scan(os.path.join(directory, name),
+                           path_prefix + (name,), added, removed)
+
+    def _forget(self, directory, removed):
+        """Drop a directory that no longer exists, and everything in it."""
+        state = self._directories.pop(directory, None)
+        if state is None:
+            return
+        removed.update(state[3])
+        for name in state[2]:
+            self._forget(os.path.join(directory, name), removed)
+
+    def _list(self, directory, path_prefix):
+        """:return: a ``(subdirectory names, {filename: path})`` tuple."""
+        extension = self.extension
+        subdirectories = []
+        files = {}
+
+        def add_file(name, full_name):
+            name_without_extension = name[:-len(extension)]
+            files[full_name] = u'/'.join(
+                path_prefix + (name_without_extension,))
+
+        if scandir is not None:
+            for entry in scandir(directory):
+                if entry.is_dir():
+                    subdirectories.append(entry.name)
+                elif entry.name.endswith(extension):
+                    add_file(entry.name, entry.path)
+        else:
+            for name in os.listdir(directory):
+                full_name = os.path.join(directory, name)
+                if os.path.isdir(full_name):
+                    subdirectories.append(name)
+                elif name.endswith(extension):
+                    add_file(name, full_name)
+        return subdirectories, files
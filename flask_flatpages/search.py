@@ -0,0 +1,217 @@
+# coding: utf8
+"""
+    flask_flatpages.search
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    An inverted index of the words in page bodies and some metadata fields,
+    used by :meth:`.FlatPages.search`.
+
+    :copyright: (c) 2010 by Simon Sapin.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import bisect
+import cPickle as pickle
+import hashlib
+import math
+import os
+import re
+
+
+_word = re.compile(r'\w+', re.UNICODE)
+_query_term = re.compile(r'(\w+)(\*?)', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the lower-cased words of a unicode string."""
+    return _word.findall(text.lower())
+
+
+class SearchIndex(object):
+    """Map words to the pages they appear in, with a weight for ranking.
+
+    :param fields: Names of metadata fields indexed along with the body.
+    """
+
+    #: Weight of a word in a metadata field, compared to the body.
+    field_weight = 5.
+
+    #: Changed when the format of saved indexes changes.
+    version = 2
+
+    def __init__(self, fields=('title',)):
+        self.fields = tuple(fields)
+        #: dict of path: (digest of the indexed text, dict of word: weight)
+        self.documents = {}
+        #: dict of word: dict of path: weight
+        self.postings = {}
+        #: Whether documents were added or removed since the last
+        #: :meth:`save` or :meth:`load`.
+        self.changed = False
+        #: Sorted list of all words for prefix search, built on first use
+        self._words = None
+
+    def add(self, page, digest=None):
+        """Index ``page``, replacing any previous version at its path.
+
+        :param digest: The result of :meth:`digest` for ``page``, if known.
+        """
+        weights = {}
+        for word in tokenize(page.body):
+            weights[word] = weights.get(word, 0) + 1
+        for word, count in weights.iteritems():
+            # Repetitions count less and less.
+            weights[word] = 1 + math.log(count)
+        for field in self.fields:
+            for word in tokenize(_text(page.meta.get(field))):
+                weights[word] = weights.get(word, 0) + self.field_weight
+        self._add(page.path, digest or self.digest(page), weights)
+
+    def digest(self, page):
+        """Return a hash of the text indexed for ``page``: its body and the
+        indexed metadata fields. Unlike :attr:`.Page.etag`, it does not
+        depend on renderers.
+        """
+        digest = hashlib.sha1()
+        texts = [page.body]
+        texts.extend(_text(page.meta.get(field)) for field in self.fields)
+        for text in texts:
+            if isinstance(text, unicode):
+                text = text.encode('utf8')
+            digest.update(text)
+            digest.update('\0')
+        return digest.hexdigest()
+
+    def _add(self, path, digest, weights):
+        self.remove(path)
+        self.documents[path] = digest, weights
+        for word, weight in weights.iteritems():
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = {}
+                self._words = None
+            postings[path] = weight
+        self.changed = True
+
+    def remove(self, path):
+        """Remove the page at ``path`` from the index, if it is there."""
+        document = self.documents.pop(path, None)
+        if document is None:
+            return
+        for word in document[1]:
+            postings = self.postings[word]
+            del postings[path]
+            if not postings:
+                del self.postings[word]
+                self._words = None
+        self.changed = True
+
+    def update(self, pages):
+        """Bring the index up to date with ``pages``, a dict of path: page.
+        Pages that did not change since they were indexed are not indexed
+        again.
+        """
+        for path in self.documents.keys():
+            if path not in pages:
+                self.remove(path)
+        for path, page in pages.iteritems():
+            document = self.documents.get(path)
+            digest = self.digest(page)
+            if document is None or document[0] != digest:
+                self.add(page, digest)
+
+    def search(self, query, limit=None):
+        """Find pages containing all words of ``query``. Words ending with
+        ``*`` match all words starting with them.
+
+        :return: a list of ``(path, score)`` tuples, best matches first.
+        """
+        scores = None
+        count = len(self.documents)
+        for word, prefix in _query_term.findall(query.lower()):
+            if prefix:
+                words = self._prefixed(word)
+            else:
+                words = [word]
+            term_scores = {}
+            for indexed_word in words:
+                postings = self.postings.get(indexed_word)
+                if not postings:
+                    continue
+                # Rare words are worth more.
+                idf = math.log(1 + count / float(len(postings)))
+                for path, weight in postings.iteritems():
+                    term_scores[path] = (term_scores.get(path, 0) +
+                                         weight * idf)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = dict((path, score + term_scores[path])
+                              for path, score in scores.iteritems()
+                              if path in term_scores)
+            if not scores:
+                return []
+        if scores is None:
+            return []
+        ranked = sorted(scores.iteritems(),
+                        key=lambda item: (-item[1], item[0]))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return ranked
+
+    def _prefixed(self, prefix):
+        words = self._words
+        if words is None:
+            words = self._words = sorted(self.postings)
+        result = []
+        for position in xrange(bisect.bisect_left(words, prefix),
+                               len(words)):
+            word = words[position]
+            if not word.startswith(prefix):
+                break
+            result.append(word)
+        return result
+
+    def save(self, filename):
+        """Write the index to ``filename``, atomically."""
+        temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(temp_filename, 'wb') as fd:
+            pickle.dump((self.version, self.fields, self.documents), fd,
+                        pickle.HIGHEST_PROTOCOL)
+        if os.name == 'nt' and os.path.exists(filename):
+            # No atomic replace on Windows.
+            os.remove(filename)
+        os.rename(temp_filename, filename)
+        self.changed = False
+
+    def load(self, filename):
+        """Read documents saved with :meth:`save`. Nothing is loaded if the
+        file is missing, invalid or for other fields.
+
+        :return: whether the index was loaded.
+        """
+        try:
+            with open(filename, 'rb') as fd:
+                version, fields, documents = pickle.load(fd)
+        except (IOError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError):
+            return False
+        if version != self.version or fields != self.fields:
+            return False
+        for path, (digest, weights) in documents.iteritems():
+            self._add(path, digest, weights)
+        self.changed = False
+        return True
+
+
+def _text(value):
+    """Return the text of a metadata value to be indexed."""
+    if value is None:
+        return u''
+    if isinstance(value, (list, tuple)):
+        return u' '.join(_text(item) for item in value)
+    if isinstance(value, str):
+        return value.decode('utf8', 'replace')
+    return unicode(value)
@@ -10,17 +10,31 @@
 from __future__ import with_statement
 
 import datetime
+import functools
 import os
 import shutil
+import sqlite3
+import subprocess
 import sys
 import tempfile
+import threading
+import time
 import unicodedata
 import unittest
 
 from contextlib import contextmanager
 
+import markdown
+import yaml
 from flask import Flask
-from flask_flatpages import FlatPages, pygments_style_defs
+import flask_flatpages
+from flask_flatpages import (CombinedPages, FlatPages, Page, PageList, Q,
+                             Query, TemplateCache, pygmented_markdown,
+                             pygments_style_defs, render_jinja)
+from flask_flatpages.cache import RenderCache, renderer_signature
+from flask_flatpages.executor import Executor
+from flask_flatpages.scanner import Scanner
+from flask_flatpages.watcher import InotifyWatcher, PollingWatcher
 from werkzeug.exceptions import NotFound
 
 
@@ -56,6 +70,16 @@ def temp_pages(app=None):
         yield FlatPages(app)
 
 
+def wait_for(predicate, timeout=5):
+    """Poll ``predicate`` until it returns a true value, and return it."""
+    deadline = time.time() + timeout
+    while True:
+        result = predicate()
+        if result or time.time() > deadline:
+            return result
+        time.sleep(0.01)
+
+
 class TestTempDirectory(unittest.TestCase):
     def test_removed(self):
         with temp_directory() as temp:
@@ -126,6 +150,394 @@ class TestFlatPages(unittest.TestCase):
         self.assertEquals(foo['versions'], [3.14, 42])
         self.assertRaises(KeyError, lambda: foo['nonexistent'])
 
+    def test_compact_pages(self):
+        pages = FlatPages(Flask(__name__))
+        foo = pages.get('foo')
+        hello = pages.get('hello')
+        self.assert_(not hasattr(foo, '__dict__'))
+        # Renderers and context are shared
+        self.assert_(foo._config is hello._config)
+        self.assertEquals(foo.html, '<p>Foo <em>bar</em></p>')
+        self.assertEquals(foo['title'], 'Foo > bar')
+        foo.clear_cache()
+        self.assertEquals((foo._html, foo._intro, foo._meta), (None,) * 3)
+        self.assertEquals(foo.html, '<p>Foo <em>bar</em></p>')
+
+        foo.html_renderer = unicode.upper
+        self.assert_(foo._config is not hello._config)
+        self.assertEquals(foo.html_renderer, unicode.upper)
+        self.assert_(hello.html_renderer is not unicode.upper)
+
+    def test_drop_meta_yaml(self):
+        app = Flask(__name__)
+        app.config['FLATPAGES_KEEP_META_YAML'] = False
+        pages = FlatPages(app)
+        foo = pages.get('foo')
+        self.assert_(foo._meta_yaml is not None)
+        self.assertEquals(foo['title'], 'Foo > bar')
+        self.assertEquals(foo._meta_yaml, None)
+        foo.clear_cache()
+        # Metadata can not be parsed again, it is kept.
+        self.assertEquals(foo['title'], 'Foo > bar')
+        # The ETag does not depend on when the source was dropped.
+        self.assertEquals(foo.etag, FlatPages(Flask(__name__)).get('foo').etag)
+        prerendered = Flask(__name__)
+        prerendered.config['FLATPAGES_KEEP_META_YAML'] = False
+        with temp_pages(prerendered) as pages:
+            pages.prerender(executor='thread')
+            self.assertEquals(pages.get('foo')._meta_yaml, None)
+            self.assertEquals(pages.get('foo').etag, foo.etag)
+
+        # Without reading the body
+        app.config['FLATPAGES_LAZY_BODY'] = True
+        foo = FlatPages(app).get('foo')
+        self.assertEquals(foo['title'], 'Foo > bar')
+        self.assertEquals(foo._body, None)
+        self.assertEquals(foo.etag, FlatPages(Flask(__name__)).get('foo').etag)
+
+    def test_meta_reuse(self):
+        if hasattr(yaml, 'CSafeLoader'):
+            self.assert_(flask_flatpages._yaml_loader is yaml.CSafeLoader)
+        with temp_pages() as pages:
+            filename = os.path.join(pages.root, 'foo', 'bar.html')
+            with open(filename, 'w') as fd:
+                fd.write('a: b\n\nbody')
+            bar = pages.get('foo/bar')
+            meta = bar.meta
+
+            # Only the body changed: the parsed metadata is reused.
+            with open(filename, 'w') as fd:
+                fd.write('a: b\n\nnew body')
+            os.utime(filename, (0, 0))
+            pages.reload()
+            new_bar = pages.get('foo/bar')
+            self.assert_(new_bar is not bar)
+            self.assertEquals(new_bar.body, 'new body')
+            self.assert_(new_bar.meta is meta)
+
+            with open(filename, 'w') as fd:
+                fd.write('a: c\n\nnew body')
+            os.utime(filename, (1, 1))
+            pages.reload()
+            self.assertEquals(pages.get('foo/bar').meta, {'a': 'c'})
+
+    def test_search(self):
+        with temp_pages() as pages:
+            paths = lambda results: [page.path for page in results]
+            self.assertEquals(paths(pages.search('page')),
+                              ['headerid', 'order/one', 'order/three',
+                               'order/two'])
+            # Words in the title weigh more than in the body.
+            self.assertEquals(paths(pages.search('two')), ['order/two'])
+            self.assertEquals(paths(pages.search('bar')), ['foo'])
+            self.assertEquals(paths(pages.search(u'世界')), ['hello'])
+            self.assertEquals(paths(pages.search('page THREE')),
+                              ['order/three'])
+            self.assertEquals(paths(pages.search('page missing')), [])
+            self.assertEquals(paths(pages.search('')), [])
+            self.assertEquals(paths(pages.search('head*')), ['headerid'])
+            self.assertEquals(paths(pages.search('page', limit=2)),
+                              ['headerid', 'order/one'])
+
+            # The index is updated when pages change.
+            filename = os.path.join(pages.root, 'foo', 'bar.html')
+            with open(filename, 'w') as fd:
+                fd.write('title: Page four\n\nSomething else')
+            os.remove(os.path.join(pages.root, 'order', 'two.html'))
+            pages.reload()
+            self.assertEquals(paths(pages.search('page')),
+                              ['foo/bar', 'headerid', 'order/one',
+                               'order/three'])
+            self.assertEquals(paths(pages.search('some*')), ['foo/bar'])
+            self.assertEquals(paths(pages.search('two')), [])
+
+    def test_search_index_file(self):
+        with temp_directory() as temp:
+            app = Flask(__name__)
+            filename = os.path.join(temp, 'search.index')
+            app.config['FLATPAGES_SEARCH_INDEX'] = filename
+            pages = FlatPages(app)
+            self.assertEquals([page.path for page in pages.search('foo')],
+                              ['foo'])
+            self.assert_(os.path.exists(filename))
+
+            # Unchanged pages are not indexed again, even with other
+            # renderers.
+            app.config['FLATPAGES_HTML_RENDERER'] = lambda text: text
+            pages = FlatPages(app)
+            pages._pages
+            search = pages._search_index()
+            self.assert_(not search.changed)
+            self.assertEquals([page.path for page in pages.search('foo')],
+                              ['foo'])
+
+            # Indexes for other fields are ignored.
+            app.config['FLATPAGES_SEARCH_FIELDS'] = ['title', 'tags']
+            pages = FlatPages(app)
+            self.assertEquals([page.path for page in pages.search('rants')],
+                              ['order/one'])
+
+    def test_search_index_saving(self):
+        with temp_pages() as pages:
+            filename = os.path.join(pages.root, 'search.index')
+            pages.app.config['FLATPAGES_SEARCH_INDEX'] = filename
+            self.assertEquals(pages.search('new'), [])
+            saved = open(filename, 'rb').read()
+
+            with open(os.path.join(pages.root, 'foo.html'), 'w') as fd:
+                fd.write('title: New\n\nnew')
+            pages.reload()
+            self.assertEquals([page.path for page in pages.search('new')],
+                              ['foo'])
+            # Written at most once per interval
+            self.assert_(pages._search.changed)
+            self.assertEquals(open(filename, 'rb').read(), saved)
+            # ... and at exit
+            flask_flatpages._save_search_indexes()
+            self.assert_(not pages._search.changed)
+            self.assertNotEquals(open(filename, 'rb').read(), saved)
+
+            pages.search_save_interval = 0
+            os.remove(os.path.join(pages.root, 'foo.html'))
+            pages.reload()
+            self.assertEquals(pages.search('new'), [])
+            self.assert_(not pages._search.changed)
+
+    def test_async(self):
+        app = Flask(__name__)
+        renders = []
+        started = threading.Event()
+        proceed = threading.Event()
+
+        def slow_renderer(text):
+            renders.append(text)
+            started.set()
+            proceed.wait(5)
+            return text.upper()
+
+        pages = FlatPages(app)
+        try:
+            foo = pages.get_async('foo').get(5)
+            self.assert_(foo is pages.get('foo'))
+            self.assertEquals(pages.get_async('nonexistent').get(5), None)
+
+            # Callbacks, for event-driven servers
+            loaded = []
+            done = threading.Event()
+
+            def callback(page):
+                loaded.append(page)
+                done.set()
+            pages.get_async('foo', callback=callback)
+            self.assert_(done.wait(5))
+            self.assertEquals(loaded, [foo])
+            done.clear()
+            result = pages.filter_async(title__noop=True,
+                                        callback=self.fail,
+                                        error_callback=callback)
+            self.assert_(done.wait(5))
+            self.assert_(isinstance(loaded[1], ValueError))
+            self.assertRaises(ValueError, result.get, 5)
+
+            app.config['FLATPAGES_HTML_RENDERER'] = slow_renderer
+            # A new instance so that pages use the new renderer
+            pages.stop_executor()
+            pages = FlatPages(app)
+            foo = pages.get('foo')
+            rendered = []
+            first = pages.render_async(foo, callback=rendered.append)
+            started.wait(5)
+            # The page is being rendered: this waits for the same result.
+            self.assert_(pages.render_async(foo, rendered.append) is first)
+            proceed.set()
+            self.assertEquals(first.get(5), 'FOO *BAR*\n')
+            self.assertEquals(foo.html, 'FOO *BAR*\n')
+            self.assertEquals(len(renders), 1)
+            self.assertEquals(rendered, ['FOO *BAR*\n'] * 2)
+
+            # Like filter(), in the order of the pages dict.
+            self.assertEquals(
+                set(page.path for page in pages.filter_async(
+                    title__startswith='T').get(5)),
+                set(['order/three', 'order/two']))
+            self.assertEquals(
+                [page.path for page in
+                 pages.order_by_async('-created').get(5)[:4]],
+                ['order/three', 'order/two', 'foo', 'order/one'])
+        finally:
+            pages.stop_executor()
+
+        app = Flask(__name__)
+        app.config['FLATPAGES_ASYNC_EXECUTOR'] = 'process'
+        app.config['FLATPAGES_ASYNC_WORKERS'] = 2
+        pages = FlatPages(app)
+        try:
+            foo = pages.get('foo')
+            self.assertEquals(pages.render_async(foo).get(10),
+                              '<p>Foo <em>bar</em></p>')
+            self.assertEquals(foo._html, '<p>Foo <em>bar</em></p>')
+        finally:
+            pages.stop_executor()
+
+    def test_single_flight(self):
+        app = Flask(__name__)
+        app.config['FLATPAGES_TIMINGS'] = True
+        renders = []
+
+        def slow_renderer(text):
+            renders.append(text)
+            time.sleep(0.05)
+            return text.upper()
+        app.config['FLATPAGES_HTML_RENDERER'] = slow_renderer
+        pages = FlatPages(app)
+        walks = []
+        pages.timings.connect(
+            lambda event, seconds, path: event == 'walk' and walks.append(1))
+
+        results = []
+
+        def request():
+            results.append(pages.get('foo').html)
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(results, ['FOO *BAR*\n'] * 8)
+        self.assertEquals(renders, ['Foo *bar*\n'])
+        self.assertEquals(len(walks), 1)
+
+        # Errors are raised in all waiting threads.
+        def failing_renderer(text):
+            time.sleep(0.05)
+            raise ValueError(text)
+        foo = pages.get('foo')
+        foo.clear_cache()
+        foo.html_renderer = failing_renderer
+        errors = []
+
+        def failing_request():
+            try:
+                foo.html
+            except ValueError, error:
+                errors.append(error)
+        threads = [threading.Thread(target=failing_request)
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(errors), 4)
+        self.assertEquals(len(set(map(id, errors))), 1)
+
+    def test_reload_while_loading(self):
+        pages = FlatPages(Flask(__name__))
+
+        class ReloadAfterLoad(object):
+            """Reload as soon as the pages lock is released, like another
+            thread waiting for it would.
+            """
+            def __init__(self, lock):
+                self.lock = lock
+                self.depth = 0
+                self.reloaded = False
+
+            def __enter__(self):
+                self.lock.acquire()
+                self.depth += 1
+
+            def __exit__(self, *exc_info):
+                self.depth -= 1
+                self.lock.release()
+                if not self.depth and not self.reloaded:
+                    self.reloaded = True
+                    pages.reload()
+
+        pages._lock = ReloadAfterLoad(pages._lock)
+        pages.get('foo')
+        self.assert_(pages._lock.reloaded)
+        # Storing the loaded pages did not undo the reload.
+        self.assert_('_pages' not in pages.__dict__)
+
+    def test_intro(self):
+        renders = []
+
+        def renderer(text):
+            renders.append(text)
+            return markdown.markdown(text)
+
+        def make_page(body):
+            del renders[:]
+            return Page('intro', '', body, renderer,
+                        flask_flatpages.render_string)
+
+        page = make_page(u'Intro\n\n<!-- more -->\n\nRest')
+        self.assertEquals(page.intro, u'<p>Intro</p>')
+        self.assertEquals(page.html,
+                          u'<p>Intro</p>\n<!-- more -->\n\n<p>Rest</p>')
+        # Cut from the HTML of the whole page
+        self.assertEquals(len(renders), 1)
+
+        # The marker is inside a paragraph: render the intro on its own.
+        page = make_page(u'Intro\n<!--more-->\nRest')
+        self.assertEquals(page.intro, u'<p>Intro</p>')
+        self.assertEquals(renders, [u'Intro\n'])
+        self.assertEquals(page.html, u'<p>Intro\n<!--more-->\nRest</p>')
+
+        page = make_page(u'No marker')
+        self.assertEquals(page.intro, u'<p>No marker</p>')
+        self.assert_(page.intro is page.html)
+        self.assertEquals(len(renders), 1)
+
+        # Only the first comment with "more" is a marker.
+        page = make_page(u'A <!-- a --> b <!-- more --> c <!-- d -->')
+        self.assertEquals(page.intro, u'<p>A <!-- a --> b </p>')
+
+    def test_fingerprint(self):
+        with temp_pages() as pages:
+            filename = os.path.join(pages.root, 'foo', 'bar.html')
+            with open(filename, 'w') as fd:
+                fd.write('a: b\n\nbody')
+            bar = pages.get('foo/bar')
+            html = bar.html
+
+            # Touched, eg. by a checkout, but not modified
+            os.utime(filename, (0, 0))
+            pages.reload()
+            self.assert_(pages.get('foo/bar') is bar)
+            self.assert_(bar.html is html)
+            self.assertEquals(bar.last_modified,
+                              datetime.datetime(1970, 1, 1))
+
+            # Not parsed again while the fingerprint is the same
+            open(filename, 'w').close()
+            os.utime(filename, (0, 0))
+            self.assertEquals(os.path.getsize(filename), 0)
+            pages._file_cache[filename] = (
+                bar, flask_flatpages._fingerprint(os.stat(filename)), None)
+            pages.reload()
+            self.assert_(pages.get('foo/bar') is bar)
+
+            # Modified in the same second with the same size: files
+            # modified recently are checked by content.
+            with open(filename, 'w') as fd:
+                fd.write('a: b\n\nbody')
+            pages.reload()
+            new_bar = pages.get('foo/bar')
+            with open(filename, 'w') as fd:
+                fd.write('a: b\n\nBODY')
+            pages.reload()
+            self.assert_(pages.get('foo/bar') is not new_bar)
+            self.assertEquals(pages.get('foo/bar').body, 'BODY')
+
+    def test_eager_meta(self):
+        app = Flask(__name__)
+        app.config['FLATPAGES_EAGER_META'] = True
+        pages = FlatPages(app)
+        for page in pages:
+            self.assert_(page._meta is not None)
+        self.assertEquals(pages.get('foo')['title'], 'Foo > bar')
+
     def test_markdown(self):
         pages = FlatPages(Flask(__name__))
         foo = pages.get('foo')
@@ -197,6 +609,61 @@ class TestFlatPages(unittest.TestCase):
             u'<p>Text</p>'
         )
 
+    def test_markdown_extensions_per_instance(self):
+        app = Flask(__name__)
+        app.config['FLATPAGES_DOCS_ROOT'] = 'pages'
+        app.config['FLATPAGES_DOCS_MARKDOWN_EXTENSIONS'] = ['headerid']
+        app.config['FLATPAGES_BLOG_ROOT'] = 'pages'
+        app.config['FLATPAGES_BLOG_MARKDOWN_EXTENSIONS'] = []
+        docs = FlatPages(app, name='docs')
+        blog = FlatPages(app, name='blog')
+        self.assert_(docs.get('headerid').html.startswith(
+            u'<h1 id="page-header">'))
+        self.assert_(blog.get('headerid').html.startswith(u'<h1>'))
+        self.assertNotEquals(docs.get('headerid').etag,
+                             blog.get('headerid').etag)
+
+    def test_markdown_converter_reuse(self):
+        pages = FlatPages(Flask(__name__))
+        extensions = pages.app.config['FLATPAGES_MARKDOWN_EXTENSIONS']
+        before = list(extensions)
+        self.assertEquals(pygmented_markdown(u'[a][x]\n\n[x]: /x'),
+                          u'<p><a href="/x">a</a></p>')
+        # Link references do not leak between documents.
+        self.assertEquals(pygmented_markdown(u'[a][x]'), u'<p>[a][x]</p>')
+        self.assertEquals(extensions, before)
+        self.assertEquals(pygmented_markdown.markdown_extensions,
+                          tuple(before))
+
+    def test_jinja_template_cache(self):
+        app = Flask(__name__)
+        app.config['FLATPAGES_TEMPLATE_RENDERER'] = render_jinja
+        app.config['FLATPAGES_TEMPLATE_CONTEXT'] = {'who': u'World'}
+        with temp_pages(app) as pages:
+            app.config['FLATPAGES_HTML_RENDERER'] = unicode.strip
+            filename = os.path.join(pages.root, 'foo', 'bar.html')
+            with open(filename, 'w') as fd:
+                fd.write('\nHello {{ who }}')
+            self.assertEquals(pages.get('foo/bar').html, u'Hello World')
+            templates = pages._templates
+            compiled = templates._templates.values()
+            self.assertEquals(len(compiled), 1)
+
+            # Re-rendering with another context does not compile again.
+            app.config['FLATPAGES_TEMPLATE_CONTEXT'] = {'who': u'You'}
+            pages.reload()
+            pages._file_cache = {}
+            self.assertEquals(pages.get('foo/bar').html, u'Hello You')
+            self.assert_(pages._templates is templates)
+            self.assertEquals(templates._templates.values(), compiled)
+
+    def test_template_errors(self):
+        templates = TemplateCache(size=1)
+        self.assertEquals(render_jinja(u'{{ a }', {}, templates), u'{{ a }')
+        self.assertEquals(render_jinja(u'{{ a }}', {'a': 1}, templates), u'1')
+        self.assertEquals(render_jinja(u'{{ b }}', {'b': 2}, templates), u'2')
+        self.assertEquals(len(templates._templates), 1)
+
     def test_other_extension(self):
         app = Flask(__name__)
         app.config['FLATPAGES_EXTENSION'] = '.txt'
@@ -206,6 +673,144 @@ class TestFlatPages(unittest.TestCase):
             set(['not_a_page', 'foo/42/not_a_page'])
         )
 
+    def test_lazy_body(self):
+        for root, encoding in (('pages', 'utf8'),
+                               ('pages_shift_jis', 'shift_jis')):
+            eager = FlatPages(Flask(__name__))
+            lazy = FlatPages(Flask(__name__))
+            for pages in (eager, lazy):
+                pages.app.config['FLATPAGES_ROOT'] = root
+                pages.app.config['FLATPAGES_ENCODING'] = encoding
+            lazy.app.config['FLATPAGES_LAZY_BODY'] = True
+            self.assertEquals(set(p.path for p in lazy),
+                              set(p.path for p in eager))
+            for page in lazy:
+                self.assertEquals(page._body, None)
+                other = eager.get(page.path)
+                self.assertEquals(page._meta_yaml, other._meta_yaml)
+                self.assertEquals(page.meta, other.meta)
+                self.assertEquals(page._body, None)
+                self.assertEquals(page.body, other.body)
+                self.assertEquals(page.html, other.html)
+
+        with temp_pages() as pages:
+            pages.app.config['FLATPAGES_LAZY_BODY'] = True
+            filename = os.path.join(pages.root, 'foo', 'bar.html')
+            with open(filename, 'w') as fd:
+                fd.write('a: b\r\nc: d\r\n  \r\nbody\r\n\r\nmore')
+            bar = pages.get('foo/bar')
+            self.assertEquals(bar.meta, {'a': 'b', 'c': 'd'})
+            self.assertEquals(bar.body, 'body\r\n\r\nmore')
+
+    def test_timings(self):
+        events = []
+        pages = FlatPages(Flask(__name__))
+        pages.timings.connect(lambda *args: events.append(args))
+        pages.get('foo')
+        # Disabled by default
+        self.assertEquals(events, [])
+
+        app = Flask(__name__)
+        app.config['FLATPAGES_TIMINGS'] = True
+        pages = FlatPages(app)
+        pages.timings.connect(lambda *args: events.append(args))
+        with app.test_request_context():
+            foo = pages.get('foo')
+            foo.html
+            foo.html
+            pages.filter(title='x')
+            pages.order_by('created')
+            totals = pages.timings.request_totals()
+        counts = dict((event, count)
+                      for event, (count, seconds) in totals.iteritems())
+        self.assertEquals(counts['walk'], 1)
+        self.assertEquals(counts['html'], 1)
+        self.assertEquals(counts['filter'], 1)
+        self.assertEquals(counts['order_by'], 1)
+        self.assert_(counts['load_file.miss'] > 1)
+        self.assertEquals(counts['load_file.miss'], counts['parse'])
+        self.assert_('load_file.hit' not in counts)
+        self.assertEquals([path for event, seconds, path in events
+                           if event == 'html'], ['foo'])
+        self.assertEquals(sum(1 for event in events if event[0] == 'walk'), 1)
+        self.assertEquals(pages.timings.request_totals(), {})
+
+        del events[:]
+        with app.test_request_context():
+            pages._walk()
+            counts = pages.timings.request_totals()
+        self.assertEquals(counts['load_file.hit'][0],
+                          totals['load_file.miss'][0])
+        self.assert_('load_file.miss' not in counts)
+
+    def test_conditional_response(self):
+        with temp_pages() as pages:
+            app = pages.app
+            foo = pages.get('foo')
+            etag = foo.etag
+            self.assertEquals(len(etag), 40)
+            self.assertEquals(foo.last_modified,
+                              datetime.datetime.utcfromtimestamp(int(
+                                  os.path.getmtime(os.path.join(
+                                      pages.root, 'foo.html')))))
+
+            @app.route('/<path:path>', methods=['GET', 'POST'])
+            def page(path):
+                return pages.render_page_response(
+                    path, lambda page: page.html.upper())
+
+            client = app.test_client()
+            response = client.get('/foo')
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(response.data, '<P>FOO <EM>BAR</EM></P>')
+            self.assertEquals(response.headers['ETag'], '"%s"' % etag)
+            last_modified = response.headers['Last-Modified']
+            self.assertEquals(client.get('/nonexistent').status_code, 404)
+
+            for headers in ({'If-None-Match': '"%s"' % etag},
+                            {'If-Modified-Since': last_modified}):
+                foo.clear_cache()
+                response = client.get('/foo', headers=headers)
+                self.assertEquals(response.status_code, 304)
+                self.assertEquals(response.data, '')
+                # Not rendered
+                self.assertEquals(foo._html, None)
+                response = client.post('/foo', headers=headers)
+                self.assertEquals(response.status_code, 200)
+            response = client.get('/foo', headers={'If-None-Match': '"x"'})
+            self.assertEquals(response.status_code, 200)
+
+            # Same content and renderers, same ETag
+            other = FlatPages(Flask(__name__))
+            self.assertEquals(other.get('foo').etag, etag)
+            self.assertNotEquals(other.get('foo/bar').etag, etag)
+            other = FlatPages(Flask(__name__))
+            other.app.config['FLATPAGES_HTML_RENDERER'] = unicode.upper
+            self.assertNotEquals(other.get('foo').etag, etag)
+
+    def test_etag_across_processes(self):
+        # Object addresses in the context differ in each process.
+        script = '\n'.join([
+            'import flask, flask_flatpages',
+            'app = flask.Flask(__name__)',
+            'app.config["FLATPAGES_ROOT"] = %r' % os.path.join(
+                os.path.dirname(flask_flatpages.__file__), 'pages'),
+            'app.config["FLATPAGES_TEMPLATE_CONTEXT"] = {',
+            '    "url_for": flask.url_for, "app": app}',
+            'print flask_flatpages.FlatPages(app).get("foo").etag',
+        ])
+        package_root = os.path.dirname(
+            os.path.dirname(os.path.abspath(flask_flatpages.__file__)))
+        etags = []
+        for i in range(2):
+            process = subprocess.Popen(
+                [sys.executable, '-c', script], cwd=package_root,
+                stdout=subprocess.PIPE)
+            etags.append(process.communicate()[0].strip())
+            self.assertEquals(process.returncode, 0)
+        self.assertEquals(len(etags[0]), 40)
+        self.assertEquals(etags[0], etags[1])
+
     def test_lazy_loading(self):
         with temp_pages() as pages:
             bar = pages.get('foo/bar')
@@ -377,6 +982,477 @@ class TestFlatPages(unittest.TestCase):
                     'order/one', 'order/two', 'order/three']))
 
 
+class TestCombinedPages(unittest.TestCase):
+    def test_named_instances(self):
+        app = Flask(__name__)
+        app.config['FLATPAGES_ROOT'] = 'nonexistent'
+        app.config['FLATPAGES_JIS_ROOT'] = 'pages_shift_jis'
+        app.config['FLATPAGES_JIS_ENCODING'] = 'shift_jis'
+        pages = FlatPages(app, name='jis')
+        self.assertEquals(pages.config('root'), 'pages_shift_jis')
+        self.assertEquals(app.config['FLATPAGES_JIS_EXTENSION'], '.html')
+        self.assertEquals(pages.get('hello')['title'], u'世界')
+        self.assert_(app.extensions['flatpages']['jis'] is pages)
+
+    def test_combined(self):
+        with temp_pages() as main:
+            app = main.app
+            app.config['FLATPAGES_JIS_ROOT'] = 'pages_shift_jis'
+            app.config['FLATPAGES_JIS_ENCODING'] = 'shift_jis'
+            jis = FlatPages(app, name='jis')
+            self.assertRaises(ValueError, CombinedPages, main, main)
+            pages = CombinedPages(jis, main)
+            self.assertEquals(len(list(pages)), 9)
+            self.assert_(pages.get('hello') is main.get('hello'))
+            self.assert_(pages.get('jis/hello') is jis.get('hello'))
+            self.assertEquals(pages.get('jis/nonexistent'), None)
+            self.assertRaises(NotFound, pages.get_or_404, 'nonexistent')
+
+            self.assertEquals(set(page.path for page in
+                                  pages.filter(title=u'世界')),
+                              set(['hello']))
+            self.assertEquals(len(pages.filter(title=u'世界')), 2)
+            self.assertEquals(len(pages.query(title=u'世界')), 2)
+            self.assertEquals(len(pages.query(~Q(title=u'世界'))), 7)
+            self.assertEquals([page.path for page in pages.search(u'世界')],
+                              ['hello', 'hello'])
+            self.assertEquals(len(pages.search(u'page', limit=2)), 2)
+            desc = pages.order_by('-created')
+            self.assertEquals([p.path for p in desc[:2]],
+                              ['order/three', 'order/two'])
+            self.assertEquals(len(desc), 9)
+            self.assert_(pages._ordering('created')._entries is
+                         pages._ordering('-created')._entries)
+
+            # Reloading one instance does not scan the other.
+            filename = os.path.join(main.root, 'order', 'one.html')
+            with open(filename, 'w') as fd:
+                fd.write(u'title: 世界\ncreated: 2012-01-01\n\nchanged'
+                         .encode('utf8'))
+            os.utime(filename, (0, 0))
+            jis_pages = jis._pages
+            main.reload()
+            self.assertEquals(len(pages.filter(title=u'世界')), 3)
+            self.assert_(jis.__dict__['_pages'] is jis_pages)
+            self.assertEquals([p.path for p in
+                               pages.order_by('-created')[:2]],
+                              ['order/one', 'order/three'])
+
+            pages.reload()
+            self.assert_('_pages' not in jis.__dict__)
+
+
+class TestScanner(unittest.TestCase):
+    def test_changes(self):
+        with temp_pages() as pages:
+            scanner = Scanner(unicode(pages.root), '.html')
+            added, removed = scanner.scan()
+            self.assertEquals(set(added.values()), set(
+                ['foo', 'foo/bar', 'foo/lorem/ipsum', 'headerid', 'hello',
+                 'order/one', 'order/two', 'order/three']))
+            self.assertEquals(removed, {})
+            self.assertEquals(scanner.scan(), ({}, {}))
+
+            shutil.rmtree(os.path.join(pages.root, 'order'))
+            open(os.path.join(pages.root, 'foo', 'new.html'), 'w').close()
+            added, removed = scanner.scan()
+            self.assertEquals(added.values(), ['foo/new'])
+            self.assertEquals(set(removed.values()), set(
+                ['order/one', 'order/two', 'order/three']))
+            self.assertEquals(len(scanner.files), 6)
+
+    def test_unchanged_directories_not_listed(self):
+        with temp_pages() as pages:
+            scanner = Scanner(unicode(pages.root), '.html')
+            scanner.scan()
+            listed = []
+            original_list = scanner._list
+
+            def _list(directory, path_prefix):
+                listed.append(directory)
+                return original_list(directory, path_prefix)
+            scanner._list = _list
+            # Trust all directory timestamps, however recent.
+            scanner.racy_delay = -1e9
+            scanner.scan()
+            scanner.scan()
+            self.assertEquals(listed, [])
+            # Recently modified directories are listed again.
+            scanner.racy_delay = 1e9
+            scanner.scan()
+            self.assertEquals(len(listed), 5)
+
+    def test_walk_patches_pages(self):
+        with temp_pages() as pages:
+            before = pages._pages
+            hello = pages.get('hello')
+            with open(os.path.join(pages.root, 'foo', 'bar.html'), 'w') as fd:
+                fd.write('\nrewritten')
+            os.remove(os.path.join(pages.root, 'order', 'one.html'))
+            open(os.path.join(pages.root, 'new.html'), 'w').close()
+            pages._file_cache[os.path.join(pages.root, 'foo', 'bar.html')] = (
+                pages.get('foo/bar'), None, None)
+            added, removed, modified = pages._walk()
+            self.assertEquals(added, set(['new']))
+            self.assertEquals(removed, set(['order/one']))
+            self.assertEquals(modified, set(['foo/bar']))
+            self.assert_(pages._pages is before)
+            self.assert_(pages.get('hello') is hello)
+            self.assertEquals(pages.get('foo/bar').body, 'rewritten')
+
+
+class TestWatcher(unittest.TestCase):
+    def check_watcher(self, watcher_class):
+        with temp_pages() as pages:
+            root = unicode(pages.root)
+            try:
+                watcher = watcher_class(root)
+            except OSError:
+                return  # Not available on this platform
+            watcher.interval = 0.05
+            watcher.start()
+            try:
+                self.assertEquals(watcher.pop_changes(), None)
+                filename = os.path.join(root, 'foo', 'bar.html')
+                # Make sure the modification time changes.
+                os.utime(filename, (0, 0))
+                directories, files = wait_for(watcher.pop_changes)
+                self.assert_(filename in files)
+
+                os.mkdir(os.path.join(root, 'new'))
+                directories, files = wait_for(watcher.pop_changes)
+                self.assert_(root in directories)
+                # Subdirectories created later are watched too.
+                time.sleep(0.1)
+                watcher.pop_changes()
+                open(os.path.join(root, 'new', 'page.html'), 'w').close()
+                directories, files = wait_for(watcher.pop_changes)
+                self.assert_(os.path.join(root, 'new') in directories)
+
+                # Atomic saves rename a new file over the page, rsync keeps
+                # its modification time.
+                time.sleep(0.1)
+                watcher.pop_changes()
+                temp_filename = os.path.join(root, 'foo', '.bar.html.tmp')
+                with open(temp_filename, 'w') as fd:
+                    fd.write('\nrenamed')
+                os.utime(temp_filename, (0, 0))
+                os.rename(temp_filename, filename)
+                directories, files = wait_for(watcher.pop_changes)
+                self.assert_(filename in files)
+            finally:
+                watcher.stop()
+            self.assert_(not watcher.running)
+
+    def test_inotify(self):
+        self.check_watcher(InotifyWatcher)
+
+    def test_polling(self):
+        self.check_watcher(PollingWatcher)
+
+    def test_watch_auto_reload(self):
+        app = Flask(__name__)
+        app.config['FLATPAGES_AUTO_RELOAD'] = 'watch'
+        with temp_pages(app) as pages:
+            try:
+                hello = pages.get('hello')
+                bar = pages.get('foo/bar')
+                pages._watcher.interval = 0.05
+                filename = os.path.join(pages.root, 'foo', 'bar.html')
+                with open(filename, 'w') as fd:
+                    fd.write('\nrewritten')
+                os.utime(filename, (0, 0))
+                open(os.path.join(pages.root, 'foo', 'new.html'), 'w').close()
+
+                def updated():
+                    with app.test_request_context():
+                        app.preprocess_request()
+                    return pages.get('foo/new') is not None and \
+                        pages.get('foo/bar') is not bar
+                self.assert_(wait_for(updated))
+                self.assertEquals(pages.get('foo/bar').body, 'rewritten')
+                # Other pages were left alone.
+                self.assert_(pages.get('hello') is hello)
+            finally:
+                pages.stop_watching()
+
+    def test_watch_renamed_page(self):
+        app = Flask(__name__)
+        app.config['FLATPAGES_AUTO_RELOAD'] = 'watch'
+        with temp_pages(app) as pages:
+            try:
+                bar = pages.get('foo/bar')
+                pages._watcher.interval = 0.05
+                filename = os.path.join(pages.root, 'foo', 'bar.html')
+                temp_filename = filename + '.tmp'
+                with open(temp_filename, 'w') as fd:
+                    fd.write('\nrenamed')
+                os.rename(temp_filename, filename)
+
+                def updated():
+                    with app.test_request_context():
+                        app.preprocess_request()
+                    return pages.get('foo/bar') is not bar
+                self.assert_(wait_for(updated))
+                self.assertEquals(pages.get('foo/bar').body, 'renamed')
+            finally:
+                pages.stop_watching()
+
+    def test_watcher_not_running(self):
+        app = Flask(__name__)
+        app.config['FLATPAGES_AUTO_RELOAD'] = 'watch'
+        with temp_pages(app) as pages:
+            try:
+                bar = pages.get('foo/bar')
+                # Like in a process forked after loading pages: the thread
+                # of the watcher is gone.
+                watcher = pages._watcher
+                watcher._stopped.set()
+                watcher._thread.join()
+                self.assert_(not watcher.running)
+                filename = os.path.join(pages.root, 'foo', 'bar.html')
+                with open(filename, 'w') as fd:
+                    fd.write('\nrewritten')
+                with app.test_request_context():
+                    app.preprocess_request()
+                self.assertEquals(pages.get('foo/bar').body, 'rewritten')
+                self.assert_(pages._watcher is not watcher)
+                self.assert_(pages._watcher.running)
+            finally:
+                pages.stop_watching()
+
+
+class TestPrerender(unittest.TestCase):
+    def check_prerender(self, executor):
+        with temp_pages() as pages:
+            hello = pages.get('hello')
+            pages.prerender(workers=2, executor=executor)
+            # Already loaded pages are kept.
+            self.assert_(pages.get('hello') is hello)
+            for page in pages:
+                self.assert_(page._html is not None)
+                self.assert_(page._intro is not None)
+            self.assertEquals(pages.get('foo').html,
+                              '<p>Foo <em>bar</em></p>')
+            self.assertEquals(pages.get('foo')['title'], 'Foo > bar')
+            self.assertEquals(hello.html, u'<p>Hello, <em>世界</em>!</p>')
+
+            # Loading again uses the same objects.
+            foo = pages.get('foo')
+            pages.reload()
+            self.assert_(pages.get('foo') is foo)
+
+    def test_processes(self):
+        self.check_prerender('process')
+
+    def test_threads(self):
+        self.check_prerender('thread')
+
+    def test_just_written(self):
+        with temp_pages() as pages:
+            # Too recent for its fingerprint to be trusted
+            with open(os.path.join(pages.root, 'new.html'), 'w') as fd:
+                fd.write('title: New\n\nJust *written*')
+            pages.prerender(executor='thread')
+            new = pages.get('new')
+            pages.reload()
+            self.assert_(pages.get('new') is new)
+            self.assertEquals(new._html, '<p>Just <em>written</em></p>')
+
+            # Pages loaded before are kept too.
+            with open(os.path.join(pages.root, 'newer.html'), 'w') as fd:
+                fd.write('title: Newer\n\nJust *written*')
+            pages.reload()
+            newer = pages.get('newer')
+            html = newer.html
+            pages.prerender(executor='thread')
+            self.assert_(pages.get('newer') is newer)
+            self.assert_(newer.html is html)
+            self.assert_(newer._intro is not None)
+
+    def test_unknown_executor(self):
+        pages = FlatPages(Flask(__name__))
+        self.assertRaises(ValueError, pages.prerender, executor='fibers')
+
+
+class TestBundle(unittest.TestCase):
+    def test_bundle(self):
+        with temp_pages() as pages:
+            filename = os.path.join(pages.root, 'pages.bundle')
+            self.assertRaises(ValueError, pages.build_bundle)
+            self.assertEquals(pages.build_bundle(filename, workers=2,
+                                                 executor='thread'), 8)
+
+            app = Flask(__name__)
+            app.config['FLATPAGES_ROOT'] = 'nonexistent'
+            app.config['FLATPAGES_BUNDLE'] = filename
+            app.config['FLATPAGES_AUTO_RELOAD'] = True
+            bundled = FlatPages(app)
+            self.assertEquals(set(page.path for page in bundled),
+                              set(page.path for page in pages))
+            hello = bundled.get('hello')
+            self.assertEquals(hello._body, None)
+            self.assertEquals(hello._html, None)
+            for page in bundled:
+                other = pages.get(page.path)
+                self.assertEquals(page.meta, other.meta)
+                self.assertEquals(page.body, other.body)
+                self.assertEquals(page.html, other.html)
+                self.assertEquals(page.intro, other.intro)
+                self.assertEquals(page.etag, other.etag)
+                self.assertEquals(page.last_modified, other.last_modified)
+            self.assertEquals(bundled.filter(title='Foo > bar'),
+                              [bundled.get('foo')])
+            bundled.prerender()
+            self.assert_(bundled.get('hello') is hello)
+
+            # Pages are loaded again when the bundle is replaced.
+            with app.test_request_context():
+                app.preprocess_request()
+            self.assert_(bundled.get('hello') is hello)
+            os.remove(os.path.join(pages.root, 'hello.html'))
+            pages.build_bundle(filename)
+            with app.test_request_context():
+                app.preprocess_request()
+            self.assertEquals(bundled.get('hello'), None)
+            self.assertEquals(bundled.get('foo')['title'], 'Foo > bar')
+
+            # Back to files
+            app.config['FLATPAGES_BUNDLE'] = None
+            app.config['FLATPAGES_ROOT'] = pages.root
+            bundled.reload()
+            self.assertEquals(bundled.get('foo').path, 'foo')
+            self.assertEquals(bundled.get('nonexistent'), None)
+
+    def test_shared_bundle(self):
+        with temp_pages() as pages:
+            filename = os.path.join(pages.root, 'pages.bundle')
+            pages.build_bundle(filename, executor='thread')
+            app = Flask(__name__)
+            app.config['FLATPAGES_BUNDLE'] = filename
+            app.config['FLATPAGES_BUNDLE_SHARED'] = True
+            shared = FlatPages(app)
+            shared.prerender()
+            hello = shared.get('hello')
+            self.assertEquals(hello._meta, pages.get('hello').meta)
+            for page in shared:
+                other = pages.get(page.path)
+                self.assertEquals(page.meta, other.meta)
+                self.assertEquals(page.body, other.body)
+                self.assertEquals(page.html, other.html)
+                self.assertEquals(page.intro, other.intro)
+                self.assertEquals(page.etag, other.etag)
+                # Only read from the mapped file
+                self.assertEquals(page._body, None)
+                self.assertEquals(page._html, None)
+                self.assertEquals(page._intro, None)
+
+    def test_invalid_bundle(self):
+        with temp_directory() as temp:
+            filename = os.path.join(temp, 'pages.bundle')
+            with open(filename, 'w') as fd:
+                fd.write('title: not a bundle\n\nfoo' * 10)
+            app = Flask(__name__)
+            app.config['FLATPAGES_BUNDLE'] = filename
+            pages = FlatPages(app)
+            self.assertRaises(ValueError, pages.get, 'foo')
+
+
+class TestRenderCache(unittest.TestCase):
+    def test_shared_between_instances(self):
+        calls = []
+
+        def counting_renderer(body):
+            calls.append(body)
+            return body.upper()
+
+        with temp_directory() as temp:
+            for i in range(2):
+                app = Flask(__name__)
+                app.config['FLATPAGES_RENDER_CACHE'] = os.path.join(
+                    temp, 'renders.sqlite')
+                app.config['FLATPAGES_HTML_RENDERER'] = counting_renderer
+                pages = FlatPages(app)
+                hello = pages.get('hello')
+                self.assertEquals(hello.html, u'HELLO, *世界*!\n')
+            # The second instance got the HTML from the cache.
+            self.assertEquals(len(calls), 1)
+
+    def test_renderer_in_key(self):
+        with temp_directory() as temp:
+            app = Flask(__name__)
+            app.config['FLATPAGES_RENDER_CACHE'] = os.path.join(
+                temp, 'renders.sqlite')
+            pages = FlatPages(app)
+            self.assertEquals(pages.get('foo').html,
+                              '<p>Foo <em>bar</em></p>')
+            pages.app.config['FLATPAGES_HTML_RENDERER'] = unicode.upper
+            pages.reload()
+            pages._file_cache = {}
+            self.assertEquals(pages.get('foo').html, 'FOO *BAR*\n')
+
+    def test_renderer_signature(self):
+        def signature(html_renderer, context={}):
+            return renderer_signature(html_renderer, render_jinja, context)
+
+        # No object addresses, which differ between processes.
+        context = {'url_for': flask_flatpages.flask.url_for,
+                   'pages': FlatPages(), 'upper': u'x'.upper}
+        self.assertFalse(' at 0x' in signature(unicode.upper, context))
+        self.assertEquals(signature(unicode.upper, context),
+                          signature(unicode.upper, dict(context)))
+        # Arguments of partials are part of the configuration.
+        html = functools.partial(markdown.markdown, output_format='html')
+        xhtml = functools.partial(markdown.markdown, output_format='xhtml')
+        self.assertNotEquals(signature(html), signature(xhtml))
+        self.assertTrue(markdown.version in signature(unicode.upper))
+
+    def test_eviction(self):
+        with temp_directory() as temp:
+            cache = RenderCache(os.path.join(temp, 'renders.sqlite'),
+                                max_size=100)
+            cache.set('a', u'x' * 60)
+            cache.set('b', u'y' * 30)
+            self.assertEquals(cache.get('a'), u'x' * 60)
+            cache.set('c', u'z' * 30)
+            # 'a' is the least recently stored entry
+            self.assertEquals(cache.get('a'), None)
+            self.assertEquals(cache.get('b'), u'y' * 30)
+            self.assertEquals(cache.get('c'), u'z' * 30)
+
+    def test_total_size(self):
+        with temp_directory() as temp:
+            filename = os.path.join(temp, 'renders.sqlite')
+            cache = RenderCache(filename, max_size=100)
+
+            def total():
+                return cache._connection().execute(
+                    "SELECT value FROM render_stats WHERE name = 'size'"
+                ).fetchone()[0]
+
+            # Sizes are in bytes of UTF-8.
+            cache.set('a', u'é' * 20)
+            self.assertEquals(total(), 40)
+            cache.set('a', u'x' * 10)
+            cache.set('b', u'y' * 30)
+            self.assertEquals(total(), 40)
+            cache.set('c', u'z' * 70)
+            self.assertEquals(cache.get('a'), None)
+            self.assertEquals(cache.get('b'), None)
+            self.assertEquals(total(), 70)
+            cache.clear()
+            self.assertEquals(total(), 0)
+
+            # Caches of older versions get the running total on first use.
+            connection = sqlite3.connect(os.path.join(temp, 'old.sqlite'))
+            connection.execute('CREATE TABLE renders (key TEXT PRIMARY KEY, '
+                               'value TEXT, size INTEGER, atime INTEGER)')
+            connection.execute("INSERT INTO renders VALUES ('a', 'x', 1, 0)")
+            connection.commit()
+            cache = RenderCache(os.path.join(temp, 'old.sqlite'))
+            self.assertEquals(total(), 1)
+
+
 class TestPageList(unittest.TestCase):
     def test_order_by(self):
         pages = FlatPages(Flask(__name__))
@@ -389,6 +1465,132 @@ class TestPageList(unittest.TestCase):
             [p.path for p in desc[:4]],
             ['order/three', 'order/two', 'foo', u'order/one'])
 
+    def test_order_by_cache(self):
+        with temp_pages() as pages:
+            desc = pages.order_by('-created')
+            self.assert_(isinstance(desc, PageList))
+            self.assert_(pages._ordering('created')._entries is
+                         pages._ordering('-created')._entries)
+            self.assertEquals(len(desc), 8)
+            self.assertEquals(desc[0].path, 'order/three')
+            self.assertEquals(desc[-5].path, 'order/one')
+            self.assertEquals([p.path for p in desc[1:3]], ['order/two', 'foo'])
+            self.assertEquals([p.path for p in desc[3:0:-1]],
+                              ['order/one', 'foo', 'order/two'])
+            self.assertRaises(IndexError, lambda: desc[8])
+            self.assertEquals(
+                [p.path for p in desc.filter(title__startswith='T')],
+                ['order/three', 'order/two'])
+
+            filename = os.path.join(pages.root, 'order', 'one.html')
+            with open(filename, 'w') as fd:
+                fd.write('title: One\ncreated: 2012-01-01\n\nNewer')
+            os.utime(filename, (0, 0))
+            os.remove(os.path.join(pages.root, 'order', 'two.html'))
+            pages.reload()
+            desc2 = pages.order_by('-created')
+            self.assertEquals([p.path for p in desc2[:3]],
+                              ['order/one', 'order/three', 'foo'])
+            self.assertEquals(len(desc2), 7)
+            self.assertEquals(desc2, sorted(
+                pages, key=lambda p: (p['created'] if 'created' in p.meta
+                                      else PageList.MINDATE, p.path),
+                reverse=True))
+            # Lists already returned are not affected.
+            self.assertEquals(len(desc), 8)
+            self.assertEquals(desc[0].path, 'order/three')
+
+    def test_invalid_metadata_on_reload(self):
+        with temp_pages() as pages:
+            paths = [p.path for p in pages.order_by('-created')]
+            self.assertEquals([p.path for p in pages.filter(title='One')],
+                              ['order/one'])
+            self.assertEquals(len(pages.search('page one')), 1)
+            filename = os.path.join(pages.root, 'order', 'one.html')
+            with open(filename) as fd:
+                content = fd.read()
+            with open(filename, 'w') as fd:
+                fd.write('title: [One\n\nBroken')
+            os.utime(filename, (0, 0))
+            pages.reload()
+            # Other pages are not affected, errors are raised when using
+            # the invalid metadata.
+            self.assertEquals(pages.get('order/two').title, 'Two')
+            self.assertRaises(yaml.YAMLError, pages.order_by, '-created')
+            self.assertRaises(yaml.YAMLError, pages.filter, title='One')
+            self.assertRaises(yaml.YAMLError, pages.search, 'page')
+
+            with open(filename, 'w') as fd:
+                fd.write(content)
+            os.utime(filename, (1, 1))
+            pages.reload()
+            self.assertEquals([p.path for p in pages.order_by('-created')],
+                              paths)
+            self.assertEquals([p.path for p in pages.filter(title='One')],
+                              ['order/one'])
+            self.assertEquals(len(pages.search('page one')), 1)
+
+    def test_query(self):
+        pages = FlatPages(Flask(__name__))
+        paths = lambda query: [page.path for page in query]
+        query = pages.query(title__startswith='T').order_by('-created')
+        self.assert_(isinstance(query, Query))
+        self.assertEquals(paths(query), ['order/three', 'order/two'])
+        self.assertEquals(len(query), 2)
+        self.assertEquals(query.first().path, 'order/three')
+        self.assertEquals(query[1].path, 'order/two')
+        self.assertEquals(query[-1].path, 'order/two')
+        self.assertRaises(IndexError, lambda: query[2])
+        self.assertEquals(paths(query[1:]), ['order/two'])
+        self.assertEquals(paths(query[::-1]), ['order/two', 'order/three'])
+        self.assertEquals(paths(query.limit(1)), ['order/three'])
+        self.assertEquals(paths(query.limit(5).limit(1)), ['order/three'])
+        self.assertEquals(paths(query.limit(0)), [])
+        self.assertEquals(pages.query(title='nonexistent').first(), None)
+
+        self.assertEquals(paths(query.filter(versions__contains=42)),
+                          ['order/two'])
+        self.assertEquals(paths(query.exclude(versions__contains=42)),
+                          ['order/three'])
+        self.assertEquals(
+            paths(pages.query(Q(title='One') | Q(title='Two'))
+                  .order_by('created')),
+            ['order/one', 'order/two'])
+        self.assertEquals(
+            paths(pages.query(Q(tags__exists=True) & ~Q(title='One'))),
+            ['order/three'])
+        self.assertEquals(len(pages.query()), 8)
+        self.assertEquals(len(pages.query(~Q())), 0)
+        self.assertEquals(len(pages.query().exclude()), 0)
+
+        # Same results with indexes and by scanning
+        for condition in (Q(tags__contains='rants') | Q(title='Two'),
+                          ~Q(created__gt=datetime.date(2010, 1, 1)),
+                          Q(title__in=['One', 'Three'], versions=[42])):
+            self.assertEquals(
+                set(paths(pages.query(condition))),
+                set(paths(Query(list(pages)).filter(condition))))
+
+        # Other sources
+        self.assertEquals(
+            paths(Query(pages.filter(title__startswith='T'))
+                  .order_by('created')),
+            ['order/two', 'order/three'])
+        self.assertEquals(
+            paths(Query(iter(pages.order_by('created')[-2:]))
+                  .order_by('-created')),
+            ['order/three', 'order/two'])
+
+        # Lazy
+        seen = []
+        def record(page):
+            seen.append(page)
+            return True
+        query = Query(pages.order_by('-created')).filter(Q()).limit(2)
+        query._condition._predicate = lambda index: record
+        self.assertEquals(len(query), 2)
+        self.assertEquals(len(seen), 2)
+
     def test_filter(self):
         pages = FlatPages(Flask(__name__))
 
@@ -443,6 +1645,189 @@ class TestPageList(unittest.TestCase):
         bsw = pages.filter(tags__startswith='article')
         self.assertEquals(bsw, [])
 
+    def test_render(self):
+        pages = FlatPages(Flask(__name__))
+        listing = PageList(pages)
+        self.assertRaises(ValueError, listing.render, 'body')
+        hello = pages.get('hello')
+        hello_html = hello.html
+        for kind in (None, 'thread', 'process'):
+            executor = kind and Executor(2, kind)
+            for page in pages:
+                page.clear_cache()
+            hello._html = hello_html
+            try:
+                self.assert_(listing.render('intro', executor) is listing)
+            finally:
+                if executor is not None:
+                    executor.close()
+            for page in pages:
+                self.assert_(page._intro is not None)
+                if kind == 'process':
+                    self.assert_(page._html is not None)
+            self.assert_(hello.html is hello_html)
+            self.assertEquals(pages.get('foo').intro,
+                              '<p>Foo <em>bar</em></p>')
+        self.assertEquals(
+            [p.path for p in pages.order_by('created').render()][-1],
+            'order/three')
+
+    def test_filter_all_any(self):
+        pages = FlatPages(Flask(__name__))
+        unindexed = PageList(pages)
+        dt = datetime.date(2010, 12, 11)
+        for source in (pages, unindexed, pages.order_by('created')):
+            self.assertEquals(
+                set(p.title for p in source.filter_all(
+                    created__gte=dt, title__startswith='T')),
+                set(['Two', 'Three']))
+            self.assertEquals(
+                set(p.title for p in source.filter_any(
+                    created__gt=dt, title='One')),
+                set(['One', 'Two', 'Three']))
+            self.assertEquals(len(source.filter_all()), 8)
+            self.assertEquals(source.filter_any(), [])
+            self.assertEquals(source.filter(), [])
+            self.assertRaises(ValueError, source.filter_all,
+                              title__noop=True)
+
+        # Pages matching several filters are only returned once, in order.
+        ordered = pages.order_by('created')
+        self.assertEquals(
+            [p.path for p in ordered.filter(created__gt=dt,
+                                            title__startswith='T')],
+            ['order/two', 'order/three'])
+        twice = PageList(list(ordered) * 2)
+        self.assertEquals(twice.filter(title__exists=True),
+                          [p for p in ordered if p.title is not None])
+
+    def test_ranges(self):
+        pages = FlatPages(Flask(__name__))
+        dt = datetime.date(2010, 12, 11)
+        self.assertEquals(
+            set(p.title for p in pages.filter(created__gt=dt)),
+            set(['Two', 'Three']))
+        self.assertEquals(
+            set(p.title for p in pages.filter(created__gte=dt)),
+            set(['Foo > bar', 'Two', 'Three']))
+        self.assertEquals(
+            set(p.title for p in pages.filter(created__lt=dt)),
+            set(['One']))
+        self.assertEquals(
+            set(p.title for p in pages.filter(created__lte=dt)),
+            set(['One', 'Foo > bar']))
+        self.assertEquals(
+            set(p.title for p in pages.exclude(created__lte=dt)),
+            set(['Two', 'Three', u'世界', 'Markdown Header ID extension',
+                 None]))
+
+    def test_index_matches_scan(self):
+        pages = FlatPages(Flask(__name__))
+        unindexed = PageList(pages)
+        queries = [
+            dict(title='Three'), dict(title=None), dict(versions=[42]),
+            dict(created=datetime.date(2009, 5, 11), title='Two'),
+            dict(title__in=['One', 'Two', u'世界']), dict(versions__in=[[42]]),
+            dict(title__exists=True), dict(tags__exists=False),
+            dict(tags__contains='politics'), dict(tags__contains=183),
+            dict(versions__contains=42), dict(title__contains='e'),
+            dict(title__startswith='T'), dict(title__startswith=u'世'),
+            dict(title__startswith=''), dict(template__startswith='head'),
+            dict(versions__gt=1), dict(created__lt=datetime.date(2011, 9, 1)),
+            dict(title__gte='One'), dict(title__lte='Three'),
+            dict(title__iexact='three'), dict(body__icontains='page'),
+        ]
+        for query in queries:
+            for negate in (False, True):
+                self.assertEquals(
+                    set(pages.filter(negate, **query)),
+                    set(unindexed.filter(negate, **query)),
+                    'Mismatch for %r' % query)
+        self.assertRaises(ValueError, pages.filter, title__noop=True)
+        # Values that can not be compared
+        for source in (pages, unindexed):
+            self.assertRaises(ValueError, source.filter, created__gt='2012')
+            self.assertRaises(ValueError, source.filter_all,
+                              title__exists=True, created__lt='2012')
+            self.assertRaises(ValueError, list,
+                              Query(source, Q(created__gte='2012')))
+        # Metadata fields are indexed, real attributes are not.
+        self.assert_(pages._index.fields['title'] is not None)
+        self.assert_(pages._index.fields['body'] is None)
+
+    def test_index_invalidation(self):
+        with temp_pages() as pages:
+            self.assertEquals(
+                [p.path for p in pages.filter(title='Two')], ['order/two'])
+            filename = os.path.join(pages.root, 'order', 'one.html')
+            with open(filename, 'w') as fd:
+                fd.write('title: Two\n\nRenamed')
+            os.utime(filename, (0, 0))
+            pages.reload()
+            self.assertEquals(
+                set(p.path for p in pages.filter(title='Two')),
+                set(['order/one', 'order/two']))
+            self.assertEquals(pages.filter(title='One'), [])
+            os.remove(filename)
+            pages.reload()
+            self.assertEquals(
+                [p.path for p in pages.filter(title='Two')], ['order/two'])
+
+    def test_index_of_older_list(self):
+        with temp_pages() as pages:
+            two = pages.filter(title='Two')
+            self.assertEquals([p.path for p in two], ['order/two'])
+            filename = os.path.join(pages.root, 'order', 'two.html')
+            with open(filename) as fd:
+                content = fd.read()
+            with open(filename, 'w') as fd:
+                fd.write(content + '\nEdited')
+            os.utime(filename, (0, 0))
+            pages.reload()
+            self.assert_(pages.get('order/two') is not two[0])
+            # The index of the list was updated in place, without the page
+            # of the list.
+            self.assertEquals(two.filter(title='Two'), two)
+            self.assertEquals(two.filter(True, title='Two'), [])
+            self.assertEquals(Query(two, Q(title='Two')).first(), two[0])
+            # Pages appended to a list are not in its index.
+            two.append(Page('extra', 'title: Two', u'', unicode, unicode))
+            self.assertEquals(len(two.filter(title='Two')), 2)
+            self.assertEquals(len(two.filter(title__in=['Two'])), 2)
+            self.assertEquals(
+                len(CombinedPages(pages).filter(title='Two')), 1)
+
+    def test_index_concurrent_updates(self):
+        pages = FlatPages(Flask(__name__))
+        index = pages._meta_index()
+        extra = [Page('extra/%d' % i, 'n: %d' % i, u'', unicode, unicode)
+                 for i in range(200)]
+        errors = []
+        done = threading.Event()
+
+        def update():
+            try:
+                while not done.isSet():
+                    for page in extra:
+                        index.add(page)
+                    for page in extra:
+                        index.remove(page)
+            except Exception, error:
+                errors.append(error)
+
+        thread = threading.Thread(target=update)
+        thread.start()
+        try:
+            for i in range(50):
+                # A new field each time: it is indexed from all pages.
+                pages.filter(**{'field%d__gt' % i: 0})
+                pages.query(n__gt=100).first()
+        finally:
+            done.set()
+            thread.join()
+        self.assertEquals(errors, [])
+        self.assertEquals(len(index.pages), len(list(pages)))
+
     def test_chaining(self):
         pages = FlatPages(Flask(__name__))
         chain = pages.filter(title__exists=True).filter(
@@ -0,0 +1,78 @@
+# coding: utf8
+"""
+    flask_flatpages.timings
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Optional measurement of the time spent loading, parsing, rendering and
+    querying pages, enabled with ``FLATPAGES_TIMINGS``.
+
+    :copyright: (c) 2010 by Simon Sapin.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import time
+import weakref
+
+import flask
+
+
+#: Clock used for all measurements.
+clock = time.time
+
+
+class Timings(object):
+    """Receive timings of page operations, pass them to callbacks and sum
+    them for each request.
+
+    Events are:
+
+    * ``'walk'``: bringing all pages up to date with the filesystem
+    * ``'load_file.hit'`` and ``'load_file.miss'``: checking one page file,
+      and reading and parsing it again when it changed
+    * ``'parse'``: splitting the content of a file into header and body
+    * ``'meta'``: parsing the YAML metadata of a page
+    * ``'html'`` and ``'intro'``: rendering a page or its introduction
+    * ``'filter'`` and ``'order_by'``: queries on :class:`.FlatPages`
+
+    Cached values are not measured: ``'meta'``, ``'html'`` and ``'intro'``
+    are only recorded when actually computed.
+    """
+
+    def __init__(self, enabled=False):
+        #: Nothing is measured unless this is true.
+        self.enabled = enabled
+        #: Functions called as ``callback(event, seconds, path)``, where
+        #: ``path`` is ``None`` for events that are not about one page.
+        self.callbacks = []
+        #: dict of request context: totals
+        self._requests = weakref.WeakKeyDictionary()
+
+    def connect(self, callback):
+        """Add a callback. Return it, so that this can be used as a
+        decorator.
+        """
+        self.callbacks.append(callback)
+        return callback
+
+    def record(self, event, seconds, path=None):
+        """Pass a measurement to the callbacks and add it to the totals of
+        the current request, if any.
+        """
+        for callback in self.callbacks:
+            callback(event, seconds, path)
+        ctx = flask._request_ctx_stack.top
+        if ctx is not None:
+            totals = self._requests.get(ctx)
+            if totals is None:
+                totals = self._requests[ctx] = {}
+            count, total = totals.get(event, (0, 0.))
+            totals[event] = count + 1, total + seconds
+
+    def request_totals(self):
+        """Return a dict of event: ``(count, seconds)`` tuples for the
+        current request, eg. to be logged in an ``after_request`` function.
+        """
+        ctx = flask._request_ctx_stack.top
+        if ctx is None:
+            return {}
+        return dict(self._requests.get(ctx, ()))
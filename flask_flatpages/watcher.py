@@ -0,0 +1,295 @@
+# coding: utf8
+"""
+    flask_flatpages.watcher
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Background threads that watch the pages root for changes, used by the
+    ``'watch'`` value of ``FLATPAGES_AUTO_RELOAD``.
+
+    :copyright: (c) 2010 by Simon Sapin.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+
+
+class Watcher(object):
+    """Base class for watchers: a daemon thread that records changed
+    directories and files until :meth:`pop_changes` is called.
+    """
+
+    #: Seconds between two checks of the stop flag or two polls.
+    interval = 1
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._directories = set()
+        self._files = set()
+        self._overflow = False
+
+    def start(self):
+        """Start watching in a new daemon thread."""
+        self._setup()
+        self._thread = threading.Thread(target=self._run,
+                                        name='flatpages-watcher')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching and wait for the thread to finish."""
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.currentThread():
+            thread.join()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.isAlive()
+
+    def pop_changes(self):
+        """Return and forget the changes recorded so far.
+
+        :return: ``None`` if nothing changed, ``True`` if changes were lost
+                 and everything should be checked again, or a
+                 ``(directories, files)`` tuple of sets of changed names.
+        """
+        # Cheap check without the lock, for the common case.
+        if not (self._directories or self._files or self._overflow):
+            return None
+        with self._lock:
+            if self._overflow:
+                changes = True
+            else:
+                changes = self._directories, self._files
+            self._directories = set()
+            self._files = set()
+            self._overflow = False
+        return changes
+
+    def _changed(self, directories=(), files=()):
+        with self._lock:
+            self._directories.update(directories)
+            self._files.update(files)
+
+    def _lost(self):
+        with self._lock:
+            self._overflow = True
+
+    def _setup(self):
+        """Prepare for watching, in the calling thread."""
+
+    def _run(self):
+        raise NotImplementedError
+
+
+class PollingWatcher(Watcher):
+    """Portable watcher that compares modification times of the whole tree
+    every :attr:`interval` seconds.
+    """
+
+    def _setup(self):
+        self._mtimes = self._snapshot()
+
+    def _snapshot(self):
+        """:return: a dict of name: (is a directory, mtime, inode). Files
+        replaced by renaming, eg. by rsync, can keep their mtime but not
+        their inode.
+        """
+        mtimes = {}
+        for directory, subdirectories, files in os.walk(self.root):
+            for names, is_dir in ((subdirectories, True), (files, False)):
+                for name in names:
+                    full_name = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(full_name)
+                    except OSError:
+                        continue
+                    mtimes[full_name] = is_dir, stat.st_mtime, stat.st_ino
+        try:
+            stat = os.stat(self.root)
+        except OSError:
+            pass
+        else:
+            mtimes[self.root] = True, stat.st_mtime, stat.st_ino
+        return mtimes
+
+    def _run(self):
+        while True:
+            self._stopped.wait(self.interval)
+            if self._stopped.isSet():
+                break
+            mtimes = self._snapshot()
+            old_mtimes = self._mtimes
+            directories = set()
+            files = set()
+            for name, state in mtimes.iteritems():
+                if old_mtimes.get(name) != state:
+                    (directories if state[0] else files).add(name)
+            for name in old_mtimes:
+                if name not in mtimes:
+                    directories.add(os.path.dirname(name))
+            self._mtimes = mtimes
+            if directories or files:
+                self._changed(directories, files)
+
+
+class InotifyWatcher(Watcher):
+    """Linux watcher using inotify through ctypes. Raises :exc:`OSError`
+    on creation when inotify is not available.
+    """
+
+    IN_CLOEXEC = 0x00080000
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    FILE_EVENTS = IN_ATTRIB | IN_CLOSE_WRITE
+    DIRECTORY_EVENTS = (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                        IN_DELETE_SELF | IN_MOVE_SELF)
+
+    _event = struct.Struct('iIII')
+
+    def __init__(self, root):
+        super(InotifyWatcher, self).__init__(root)
+        libc_name = ctypes.util.find_library('c')
+        # ctypes.get_errno() is new in Python 2.6.
+        if (not sys.platform.startswith('linux') or not libc_name or
+                not hasattr(ctypes, 'get_errno')):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._libc = libc
+        self._fd = None
+        #: dict of watch descriptor: directory
+        self._watches = {}
+        self._encoding = sys.getfilesystemencoding()
+
+    def _check(self, result):
+        if result < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return result
+
+    def stop(self):
+        thread = self._thread
+        super(InotifyWatcher, self).stop()
+        fd = self._fd
+        if fd is not None and thread is not threading.currentThread():
+            # Not closed by the thread, eg. in a forked process where the
+            # thread does not exist.
+            self._fd = None
+            os.close(fd)
+
+    def _setup(self):
+        self._fd = self._check(self._libc.inotify_init1(self.IN_CLOEXEC))
+        self._watch_tree(self.root)
+
+    def _watch_tree(self, top):
+        for directory, subdirectories, files in os.walk(top):
+            self._watch(directory)
+
+    def _watch(self, directory):
+        path = directory
+        if isinstance(path, unicode):
+            path = path.encode(self._encoding)
+        wd = self._libc.inotify_add_watch(
+            self._fd, path,
+            self.FILE_EVENTS | self.DIRECTORY_EVENTS | self.IN_ONLYDIR)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code in (errno.ENOENT, errno.ENOTDIR):
+                # Removed in the meantime.
+                return
+            if code == errno.ENOSPC:
+                # Out of watches: some changes will go unnoticed.
+                self._lost()
+                return
+            raise OSError(code, os.strerror(code))
+        self._watches[wd] = directory
+
+    def _run(self):
+        fd = self._fd
+        try:
+            while not self._stopped.isSet():
+                readable, _, _ = select.select([fd], [], [], self.interval)
+                if readable:
+                    self._read(os.read(fd, 64 * 1024))
+        finally:
+            os.close(fd)
+            self._fd = None
+
+    def _read(self, data):
+        directories = set()
+        files = set()
+        offset = 0
+        size = self._event.size
+        while offset < len(data):
+            wd, mask, cookie, length = self._event.unpack_from(data, offset)
+            name = data[offset + size:offset + size + length].rstrip('\0')
+            offset += size + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                self._lost()
+                continue
+            if mask & self.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if not name:
+                # Event on the watched directory itself.
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    directories.add(os.path.dirname(directory))
+                continue
+            try:
+                name = name.decode(self._encoding)
+            except UnicodeDecodeError:
+                pass
+            full_name = os.path.join(directory, name)
+            if mask & self.DIRECTORY_EVENTS:
+                directories.add(directory)
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    if mask & self.IN_ISDIR:
+                        self._watch_tree(full_name)
+                    else:
+                        # A file replaced by renaming another over it, as
+                        # in atomic saves, is not in the listing changes.
+                        files.add(full_name)
+            elif not mask & self.IN_ISDIR:
+                files.add(full_name)
+        if directories or files:
+            self._changed(directories, files)
+
+
+def make_watcher(root):
+    """Return an unstarted :class:`InotifyWatcher` for ``root`` if possible,
+    or a :class:`PollingWatcher`.
+    """
+    try:
+        return InotifyWatcher(root)
+    except OSError:
+        return PollingWatcher(root)